@@ -0,0 +1,434 @@
+#! /usr/bin/env python
+#
+# Benchmarks for http-replicator: each scenario starts one or more replicator
+# processes on a scratch cache directory, drives them with concurrent aiohttp
+# clients, and reports throughput and download latencies (p50/p99) together with
+# the CPU time and peak memory of the replicator process itself (taken from its
+# rusage once it has exited).  Scenarios that need an upstream server get the
+# stand-in HTTP and FTP servers of extras/fakeupstream.py, so nothing here
+# touches the network.  The "routing" scenario is a micro-benchmark of the
+# per-request path and address lookups, run in this process.
+#
+# usage: extras/benchmark.py [--size MIB] [--clients N] [--rounds N] [--link MIBPS]
+#                            [SCENARIO ...]
+
+import argparse, asyncio, functools, os, random, shutil, signal, socket, subprocess, sys
+import tempfile, time
+import aiohttp
+
+TOPDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REPLICATOR = os.path.join(TOPDIR, 'http-replicator')
+FAKEUPSTREAM = os.path.join(TOPDIR, 'extras', 'fakeupstream.py')
+BIND = '127.0.0.1'
+#a host:port which nobody listens on; --offline cache hits never try to connect to it
+UPSTREAM = '127.0.0.1:9'
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind((BIND, 0))
+        return s.getsockname()[1]
+
+
+def wait_listening(proc, port, what):
+    deadline = time.time() + 10
+    while True:  #poll, rather than sleep, until the process accepts connections
+        try:
+            socket.create_connection((BIND, port), timeout=1).close()
+            break
+        except OSError:
+            assert proc.poll() is None, f'{what} failed to start'
+            assert time.time() < deadline, f'{what} did not start listening'
+            time.sleep(0.05)
+
+
+class Replicator:
+    def __init__(self, root, *args):
+        self.port = free_port()
+        self.proxy = f'http://{BIND}:{self.port}'
+        cmd = [sys.executable, REPLICATOR, '-b', BIND, '-p', str(self.port), '-r', root, *args]
+        quiet = subprocess.DEVNULL
+        self.proc = subprocess.Popen(cmd, cwd=TOPDIR, stdout=quiet, stderr=quiet)
+        wait_listening(self.proc, self.port, 'replicator')
+
+    def stop(self):
+        #returns the cpu seconds (user+system) and peak memory (in MiB) used by the replicator
+        #during its lifetime
+        self.proc.send_signal(signal.SIGINT)
+        _, _, rusage = os.wait4(self.proc.pid, 0)
+        self.proc.returncode = 0
+        return rusage.ru_utime + rusage.ru_stime, rusage.ru_maxrss / 1024
+
+
+class Upstream:
+    #extras/fakeupstream.py, serving the files below root over HTTP and FTP
+    def __init__(self, root, *args):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self.http, self.ftp = free_port(), free_port()
+        cmd = [sys.executable, FAKEUPSTREAM, '--bind', BIND, '--http', str(self.http), '--ftp',
+               str(self.ftp), *args, root]
+        self.proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        wait_listening(self.proc, self.http, 'upstream')
+        wait_listening(self.proc, self.ftp, 'upstream')
+
+    def add(self, name, nbytes, scheme='http', query=''):
+        #a new file of nbytes random bytes, and its url
+        write_random(os.path.join(self.root, name), nbytes)
+        port = self.http if scheme == 'http' else self.ftp
+        return f'{scheme}://{BIND}:{port}/{name}' + (f'?{query}' if query else '')
+
+    def stop(self):
+        self.proc.kill()
+        self.proc.wait()
+
+
+async def raw_get(proxy, url):
+    #GET of url through the proxy, for schemes which aiohttp will not request (i.e., ftp);
+    #returns the size of the response body
+    host, port = proxy[len('http://'):].rsplit(':', 1)
+    reader, writer = await asyncio.open_connection(host, int(port))
+    try:
+        writer.write(f'GET {url} HTTP/1.0\r\n\r\n'.encode())
+        status = await reader.readline()
+        assert status.split()[1] in (b'200', b'206'), f'unexpected status {status}'
+        while (await reader.readline()).strip():
+            pass  #skip headers
+        nbytes = 0
+        while True:
+            chunk = await reader.read(1 << 16)
+            if not chunk:
+                return nbytes
+            nbytes += len(chunk)
+    finally:
+        writer.close()
+
+
+async def fetch_all(proxy, requests, clients):
+    #download every request (a url, or a (url, headers) pair) in requests, with at most "clients"
+    #downloads in flight; returns total bytes and the time each download took
+    total, latencies, queue = 0, [], list(requests)
+
+    async def client(session):
+        nonlocal total
+        while queue:
+            request = queue.pop()
+            url, headers = (request, None) if isinstance(request, str) else request
+            start = time.time()
+            if not url.startswith('http:'):
+                nbytes = await raw_get(proxy, url)
+                total += nbytes
+                latencies.append(time.time() - start)
+                continue
+            async with session.get(url, proxy=proxy, headers=headers) as response:
+                assert response.status in (200, 206), f'unexpected status {response.status}'
+                async for chunk in response.content.iter_chunked(1 << 16):
+                    total += len(chunk)
+            latencies.append(time.time() - start)
+
+    timeout = aiohttp.ClientTimeout(total=None)
+    connector = aiohttp.TCPConnector(force_close=True)  #one connection per download, like wget
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        await asyncio.gather(*(client(session) for _ in range(clients)))
+    return total, latencies
+
+
+def percentile(latencies, q):
+    latencies = sorted(latencies)
+    return latencies[min(int(q * len(latencies)), len(latencies) - 1)] * 1000 if latencies else 0
+
+
+def report(name, nbytes, elapsed, usage, latencies=()):
+    cpu, memory = usage
+    gib = nbytes / (1 << 30)
+    print(f'{name:<32} {nbytes / elapsed / (1 << 20):10.1f} MiB/s'
+          f' {elapsed:8.2f} s wall {cpu:8.2f} s cpu {cpu / gib if gib else 0:8.2f} cpu-s/GiB')
+    if latencies:
+        print(f'{"":<32} {len(latencies):10d} reqs  p50 {percentile(latencies, 0.5):9.2f} ms'
+              f'  p99 {percentile(latencies, 0.99):9.2f} ms  {memory:8.1f} MiB peak rss')
+
+
+def run(root, requests, clients, name, *args):
+    replicator = Replicator(root, *args)
+    try:
+        start = time.time()
+        nbytes, latencies = asyncio.get_event_loop().run_until_complete(
+            fetch_all(replicator.proxy, requests, clients))
+        elapsed = time.time() - start
+    finally:
+        usage = replicator.stop()
+    report(name, nbytes, elapsed, usage, latencies)
+
+
+def write_random(path, nbytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        block = os.urandom(min(nbytes, 1 << 20))
+        for offset in range(0, nbytes, len(block)):
+            f.write(block[:nbytes - offset])
+        f.flush()
+        os.fsync(f.fileno())  #so that drop_page_cache() can drop all of it
+
+
+def populate(root, name, nbytes):
+    #a file straight in the cache, for --offline scenarios
+    write_random(os.path.join(root, UPSTREAM, name), nbytes)
+    return f'http://{UPSTREAM}/{name}'
+
+
+def drop_page_cache(path):
+    #make the next read of the file come from the disk (unless it is on tmpfs, or the like)
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+async def fetch_timed(proxy, url, done):
+    #fetch url over and over, until done() is true; returns how long each fetch took
+    latencies = []
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(force_close=True)) as session:
+        while not done():
+            start = time.time()
+            async with session.get(url, proxy=proxy) as response:
+                assert response.status == 200, f'unexpected status {response.status}'
+                await response.read()
+            latencies.append(time.time() - start)
+    return latencies
+
+
+def scenario_sendfile(root, opts):
+    #complete cache hits, served with and without the zero-copy sendfile() path
+    url = populate(root, 'sendfile.bin', opts.size << 20)
+    urls = [url] * (opts.clients * opts.rounds)
+    run(root, urls, opts.clients, 'cache hit, sendfile()', '--offline')
+    run(root, urls, opts.clients, 'cache hit, buffered copy', '--offline', '--no-sendfile')
+
+
+def scenario_diskio(root, opts):
+    #latency of small cache hits while other clients stream large files that are not in the page
+    #cache, with disk I/O on threads and in the event loop
+    hot = populate(root, 'hot.bin', 64 << 10)
+    cold = [populate(root, f'cold{i}.bin', opts.size << 20) for i in range(opts.clients)]
+    for name, args in ('disk threads', ()), ('disk I/O in event loop', ('--diskthreads', '0')):
+        for url in cold:
+            drop_page_cache(os.path.join(root, url[len('http://'):]))
+        replicator = Replicator(root, '--offline', *args)
+        try:
+            loop = asyncio.get_event_loop()
+            start = time.time()
+            cold_task = asyncio.ensure_future(fetch_all(replicator.proxy, cold, opts.clients))
+            latencies = loop.run_until_complete(fetch_timed(replicator.proxy, hot,
+                                                            cold_task.done))
+            nbytes, _ = loop.run_until_complete(cold_task)
+            elapsed = time.time() - start
+        finally:
+            usage = replicator.stop()
+        report(f'uncached files, {name}', nbytes, elapsed, usage)
+        p50, p99, top = (percentile(latencies, q) for q in (0.5, 0.99, 1))
+        print(f'{"  small hits meanwhile":<32} {len(latencies):10d} reqs  p50 {p50:9.2f} ms'
+              f'  p99 {p99:9.2f} ms  max {top:7.2f} ms')
+
+
+def cache_dir(root, name='cache'):
+    path = os.path.join(root, name)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def prime(root, requests):
+    #get requests into the cache, before measuring what it does with them
+    replicator = Replicator(root)
+    try:
+        asyncio.get_event_loop().run_until_complete(fetch_all(replicator.proxy, requests, 1))
+    finally:
+        replicator.stop()
+
+
+def scenario_miss(root, opts):
+    #every client downloads a file of its own, which is not in the cache yet
+    upstream = Upstream(os.path.join(root, 'upstream'))
+    try:
+        for name, scheme, query in (('http', 'http', ''), ('http, chunked', 'http', 'chunked'),
+                                    ('ftp', 'ftp', '')):
+            urls = [upstream.add(f'{scheme}{query}{i}.bin', opts.size << 20, scheme, query)
+                    for i in range(opts.clients)]
+            run(cache_dir(root, f'cache-{scheme}{query}'), urls, opts.clients, f'cold miss, {name}')
+    finally:
+        upstream.stop()
+
+
+def scenario_hit(root, opts):
+    #cached files, revalidated with the upstream server on every request, or served while fresh
+    upstream = Upstream(os.path.join(root, 'upstream'))
+    try:
+        urls = [upstream.add(f'hit{i}.bin', opts.size << 20) for i in range(opts.clients)]
+        cache = cache_dir(root)
+        prime(cache, urls)
+        run(cache, urls * opts.rounds, opts.clients, 'warm hit, revalidated')
+        run(cache, urls * opts.rounds, opts.clients, 'warm hit, fresh', '--ttl', '3600')
+    finally:
+        upstream.stop()
+
+
+def scenario_merged(root, opts):
+    #all clients ask for the same file at once, which comes over a slow link
+    upstream = Upstream(os.path.join(root, 'upstream'))
+    try:
+        url = upstream.add('merged.bin', opts.size << 20, query=f'rate={opts.link << 20}')
+        run(cache_dir(root), [url] * opts.clients, opts.clients,
+            f'merged download, {opts.link} MiB/s link')
+    finally:
+        upstream.stop()
+
+
+def scenario_range(root, opts):
+    #requests for random 1 MiB ranges of a cached file
+    upstream = Upstream(os.path.join(root, 'upstream'))
+    try:
+        size = opts.size << 20
+        url = upstream.add('range.bin', size)
+        cache = cache_dir(root)
+        prime(cache, [url])
+        starts = [random.randrange(0, max(size - (1 << 20), 1)) for _ in range(opts.clients * 16)]
+        requests = [(url, {'Range': f'bytes={start}-{start + (1 << 20) - 1}'}) for start in starts]
+        run(cache, requests, opts.clients, 'range requests, 1 MiB')
+    finally:
+        upstream.stop()
+
+
+def time_per_call(fn, args):
+    #microseconds per call of fn, over all of args
+    start = time.perf_counter()
+    for arg in args:
+        fn(arg)
+    return (time.perf_counter() - start) / len(args) * 1e6
+
+
+def scenario_routing(root, opts):
+    #per-request cost of mapping paths to cacheids through --alias prefixes, and of checking
+    #client addresses against --ip networks: the linear scans of old against the compiled tables
+    #of replicator/Routing.py, and with the memo of recent cacheids; also, of finding the owner
+    #of a cacheid with --peer-hash.  Runs in this process only
+    sys.path.insert(0, TOPDIR)
+    from replicator.Routing import CidrTable, HashRing, PrefixTable, normalize_path
+    from ipaddress import ip_address, ip_network
+    rnd = random.Random(1)
+    count, lookups = 500, 20000
+    distros = [f'/distro{i}/releases/{rnd.randrange(100)}/' for i in range(count)]
+    aliasmap = [(prefix, f'/mirror/d{i}') for i, prefix in enumerate(distros)]
+    paths = [f'{rnd.choice(distros)}pkg/{rnd.randrange(1000)}/file{rnd.randrange(50)}.tar.xz'
+             for _ in range(lookups)]
+    networks = [ip_network((rnd.getrandbits(32), rnd.randrange(8, 29)), strict=False)
+                for _ in range(count)]
+    addresses = [str(rnd.choice(networks).network_address + 1) for _ in range(lookups)]
+
+    def linear_alias(path):
+        for prefix, destdir in aliasmap:
+            if os.path.commonprefix((path, prefix)) == prefix:
+                return destdir + path[len(prefix):]
+        return path
+
+    def linear_cidr(ip):
+        ip = ip_address(ip)
+        return any(ip in network for network in networks)
+
+    aliases, cidrs = PrefixTable(aliasmap), CidrTable((network, True) for network in networks)
+    ring = HashRing(f'http://node{i}:8080' for i in range(16))
+    memoized = functools.lru_cache(maxsize=4096)(lambda path: normalize_path(path, 255, aliases))
+    #a mirror's traffic: most requests are for a few thousand popular paths
+    popular = [rnd.choice(paths[:2000]) for _ in range(lookups)]
+    for name, fn, args in (
+        (f'{count} aliases, linear scan', linear_alias, paths),
+        (f'{count} aliases, prefix trie', aliases.match, paths),
+        (f'{count} CIDRs, linear scan', linear_cidr, addresses),
+        (f'{count} CIDRs, compiled table', cidrs.lookup, addresses),
+        ('cacheid, computed', lambda path: normalize_path(path, 255, aliases), popular),
+        ('cacheid, memoized', memoized, popular),
+        ('owner, hash ring of 16 peers', ring.owner, paths),
+    ):
+        print(f'{name:<32} {time_per_call(fn, args):10.2f} us/request')
+
+
+async def fetch_staggered(proxy, url, clients, interval):
+    #one download of url per client, the i-th starting i*interval seconds after the first; returns
+    #the total bytes and, for each download, the time from the first start to its last byte
+    start = time.time()
+
+    async def client(session, i):
+        await asyncio.sleep(i * interval)
+        async with session.get(url, proxy=proxy) as response:
+            assert response.status == 200, f'unexpected status {response.status}'
+            nbytes = len(await response.read())
+        return nbytes, time.time() - start
+
+    timeout = aiohttp.ClientTimeout(total=None)
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(force_close=True),
+                                     timeout=timeout) as session:
+        results = await asyncio.gather(*(client(session, i) for i in range(clients)))
+    return sum(n for n, _ in results), [t for _, t in results]
+
+
+def scenario_chunked(root, opts):
+    #a file of unknown length (sent chunked) over a slow link, with clients joining one after
+    #another while it downloads: each should get its last byte when the upstream sends it
+    upstream = Upstream(os.path.join(root, 'upstream'))
+    try:
+        url = upstream.add('chunked.bin', opts.size << 20,
+                           query=f'chunked&rate={opts.link << 20}')
+        loop = asyncio.get_event_loop()
+        start = time.time()
+        loop.run_until_complete(fetch_staggered(None, url, 1, 0))
+        direct = time.time() - start
+        replicator = Replicator(cache_dir(root))
+        try:
+            start = time.time()
+            nbytes, latencies = loop.run_until_complete(
+                fetch_staggered(replicator.proxy, url, opts.clients, direct / 2 / opts.clients))
+            elapsed = time.time() - start
+        finally:
+            usage = replicator.stop()
+        report(f'chunked download, {opts.link} MiB/s', nbytes, elapsed, usage)
+        p50, p99 = (percentile(latencies, q) for q in (0.5, 0.99))
+        print(f'{"  time to last byte":<32} {len(latencies):10d} reqs  p50 {p50:9.2f} ms'
+              f'  p99 {p99:9.2f} ms  direct {direct * 1000:7.2f} ms')
+    finally:
+        upstream.stop()
+
+
+SCENARIOS = {
+    'miss': scenario_miss,
+    'hit': scenario_hit,
+    'merged': scenario_merged,
+    'range': scenario_range,
+    'chunked': scenario_chunked,
+    'sendfile': scenario_sendfile,
+    'diskio': scenario_diskio,
+    'routing': scenario_routing,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark http-replicator')
+    parser.add_argument('--size', default=256, type=int, help='test file size in MiB')
+    parser.add_argument('--clients', default=8, type=int, help='concurrent clients')
+    parser.add_argument('--rounds', default=4, type=int, help='downloads per client')
+    parser.add_argument('--link', default=100, type=int, metavar='MIBPS',
+                        help='upstream speed, in MiB/s, for the merged-download scenario')
+    parser.add_argument('scenario', nargs='*',
+                        help=f'scenarios to run, from {{{",".join(SCENARIOS)}}} (default: all)')
+    opts = parser.parse_args()
+    for name in opts.scenario:
+        if name not in SCENARIOS:
+            parser.error(f'unknown scenario: {name}')
+    for name in opts.scenario or SCENARIOS:
+        root = tempfile.mkdtemp(prefix='replicator-bench-')
+        try:
+            SCENARIOS[name](root, opts)
+        finally:
+            shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+#! /usr/bin/env python
+#
+# Stand-in upstream servers for benchmarking http-replicator without a network:
+# serves the files below ROOT over HTTP and/or FTP.  The HTTP server answers
+# Range requests (206, or 416 when unsatisfiable), If-Range, If-None-Match and
+# If-Modified-Since (304); a "chunked" query parameter makes it send its response
+# without Content-Length, in chunked encoding, "rate=BYTES" slows it down to BYTES
+# per second, and "digest" makes it send a Repr-Digest header.  The FTP server
+# does what the replicator needs of it: login, MDTM, SIZE, EPSV/PASV, REST and
+# RETR.  --rate applies to everything it sends.
+#
+# usage: extras/fakeupstream.py [--http PORT] [--ftp PORT] [--rate BYTES] ROOT
+
+import argparse, asyncio, base64, email.utils, hashlib, os, re, time
+from aiohttp import web
+
+BLOCK = 1 << 16
+
+
+async def send_file(path, offset, count, write, rate):
+    #send count bytes (or up to the end of the file, if None) from offset, at up to rate bytes/s
+    start, sent = time.monotonic(), 0
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        while count is None or sent < count:
+            block = f.read(BLOCK if count is None else min(BLOCK, count - sent))
+            if not block:
+                break
+            await write(block)
+            sent += len(block)
+            if rate:
+                delay = start + sent / rate - time.monotonic()
+                if 0 < delay:
+                    await asyncio.sleep(delay)
+
+
+class HttpUpstream:
+    def __init__(self, root, rate):
+        self.root, self.rate = root, rate
+
+    def _unmodified(self, request, etag, mtime):
+        if 'if-none-match' in request.headers:
+            return etag in request.headers['if-none-match']
+        since = email.utils.parsedate(request.headers.get('if-modified-since', ''))
+        return since is not None and int(mtime) <= email.utils.mktime_tz(since + (0, ))
+
+    def _range(self, request, etag, last_modified, size):
+        #(start, end) of a satisfiable single range, False for an unsatisfiable one, or None
+        match = re.match(r'bytes=(\d*)-(\d*)$', request.headers.get('range', ''))
+        if_range = request.headers.get('if-range', None)
+        if match is None or (if_range is not None and if_range not in (etag, last_modified)):
+            return None
+        first, last = match.groups()
+        if first:
+            start, end = int(first), min(int(last) + 1, size) if last else size
+        elif last:
+            start, end = max(size - int(last), 0), size
+        else:
+            return None
+        return (start, end) if start < end else False
+
+    async def handle(self, request):
+        path = os.path.join(self.root, request.path.lstrip('/'))
+        if not os.path.isfile(path):
+            return web.Response(status=404)
+        stat = os.stat(path)
+        size, mtime = stat.st_size, stat.st_mtime
+        etag = f'"{size:x}-{int(mtime):x}"'
+        last_modified = email.utils.formatdate(mtime, usegmt=True)
+        headers = {'ETag': etag, 'Last-Modified': last_modified, 'Accept-Ranges': 'bytes'}
+        if self._unmodified(request, etag, mtime):
+            return web.Response(status=304, headers=headers)
+        span = self._range(request, etag, last_modified, size)
+        if span is False:
+            headers['Content-Range'] = f'bytes */{size}'
+            return web.Response(status=416, headers=headers)
+        if 'digest' in request.query:
+            with open(path, 'rb') as f:
+                digest = base64.b64encode(hashlib.sha256(f.read()).digest()).decode()
+            headers['Repr-Digest'] = f'sha-256=:{digest}:'
+        response = web.StreamResponse(headers=headers)
+        start, end = span or (0, size)
+        if span:
+            response.set_status(206)
+            response.headers['Content-Range'] = f'bytes {start}-{end - 1}/{size}'
+        if 'chunked' in request.query:
+            response.enable_chunked_encoding()
+        else:
+            response.content_length = end - start
+        await response.prepare(request)
+        if request.method == 'GET':
+            rate = float(request.query.get('rate', self.rate))
+            await send_file(path, start, end - start, response.write, rate)
+        await response.write_eof()
+        return response
+
+
+class FtpUpstream:
+    def __init__(self, root, rate):
+        self.root, self.rate = root, rate
+
+    async def handle(self, reader, writer):
+        def reply(line):
+            writer.write(f'{line}\r\n'.encode())
+
+        reply('220 fake upstream ready')
+        offset, data_server, data_conns = 0, None, asyncio.Queue()
+
+        async def on_data_conn(data_reader, data_writer):
+            await data_conns.put(data_writer)
+
+        while True:
+            line = (await reader.readline()).decode().strip()
+            if not line:
+                break
+            cmd, _, arg = line.partition(' ')
+            cmd, path = cmd.upper(), os.path.join(self.root, arg.lstrip('/'))
+            if cmd == 'USER':
+                reply('331 any password will do')
+            elif cmd == 'PASS':
+                reply('230 logged in')
+            elif cmd in ('TYPE', 'NOOP'):
+                reply('200 ok')
+            elif cmd in ('MDTM', 'SIZE') and not os.path.isfile(path):
+                reply('550 no such file')
+            elif cmd == 'MDTM':
+                reply('213 ' + time.strftime('%Y%m%d%H%M%S', time.gmtime(os.stat(path).st_mtime)))
+            elif cmd == 'SIZE':
+                reply(f'213 {os.stat(path).st_size}')
+            elif cmd in ('EPSV', 'PASV'):
+                host = writer.get_extra_info('sockname')[0]
+                data_server = await asyncio.start_server(on_data_conn, host, 0)
+                port = data_server.sockets[0].getsockname()[1]
+                if cmd == 'EPSV':
+                    reply(f'229 entering extended passive mode (|||{port}|)')
+                else:
+                    address = host.replace('.', ',')
+                    reply(f'227 entering passive mode ({address},{port >> 8},{port & 255})')
+            elif cmd == 'REST':
+                offset = int(arg)
+                reply('350 restarting')
+            elif cmd == 'RETR' and (data_server is None or not os.path.isfile(path)):
+                reply('550 no such file, or no data connection')
+            elif cmd == 'RETR':
+                reply('150 sending')
+                data_writer = await data_conns.get()
+
+                async def write(block):
+                    data_writer.write(block)
+                    await data_writer.drain()
+
+                await send_file(path, offset, None, write, self.rate)
+                data_writer.close()
+                data_server.close()
+                offset, data_server = 0, None
+                reply('226 transfer complete')
+            elif cmd == 'QUIT':
+                reply('221 goodbye')
+                break
+            else:
+                reply('502 not implemented')
+            await writer.drain()
+        writer.close()
+
+
+async def serve(opts):
+    if opts.http:
+        runner = web.ServerRunner(web.Server(HttpUpstream(opts.root, opts.rate).handle),
+                                  access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, opts.bind, opts.http).start()
+    if opts.ftp:
+        await asyncio.start_server(FtpUpstream(opts.root, opts.rate).handle, opts.bind, opts.ftp)
+    await asyncio.Event().wait()  #until killed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='fake upstream servers for benchmarks')
+    parser.add_argument('root', help='directory of files to serve')
+    parser.add_argument('--bind', default='127.0.0.1', help='address to listen on')
+    parser.add_argument('--http', type=int, metavar='PORT', help='serve HTTP on PORT')
+    parser.add_argument('--ftp', type=int, metavar='PORT', help='serve FTP on PORT')
+    parser.add_argument('--rate', default=0, type=float, metavar='BYTES',
+                        help='send at most BYTES per second on each connection (default: no limit)')
+    opts = parser.parse_args()
+    try:
+        asyncio.get_event_loop().run_until_complete(serve(opts))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
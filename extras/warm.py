@@ -0,0 +1,41 @@
+#! /usr/bin/env python
+#
+# Preloads the cache of a running http-replicator: sends a list of urls (one per
+# line, from the given manifest files or from standard input) to the replicator's
+# --metrics port, which fetches them into the cache as clients' GETs would, then
+# reports progress until the job is done.  Exits with status 1 if any url failed.
+#
+# usage: extras/warm.py --admin HOST:PORT [--interval SECONDS] [MANIFEST ...]
+
+import argparse, json, sys, time, urllib.request
+
+
+def request(admin, path, data=None):
+    with urllib.request.urlopen(f'http://{admin}{path}', data=data) as response:
+        return json.load(response)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='preload the cache of http-replicator')
+    parser.add_argument('manifest', nargs='*', help='files listing urls (default: stdin)')
+    parser.add_argument('--admin', required=True, metavar='HOST:PORT',
+                        help='address and --metrics port of the replicator')
+    parser.add_argument('--interval', default=1.0, type=float, metavar='SECONDS',
+                        help='time between progress reports (default=1)')
+    args = parser.parse_args()
+
+    text = ''.join(open(path).read() + '\n' for path in args.manifest) if args.manifest \
+        else sys.stdin.read()
+    report = request(args.admin, '/warm', text.encode())
+    print(f'job {report["job"]}: {report["total"]} urls')
+    while report['finished'] is None:
+        time.sleep(args.interval)
+        report = request(args.admin, f'/warm/{report["job"]}')
+        print(f'{report["done"]} done, {report["failed"]} failed, {report["pending"]} pending')
+    for error in report['errors']:
+        print(f'failed: {error["url"]} ({error["error"]})')
+    return 1 if report['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,97 @@
+import asyncio, collections, time
+from .Params import OPTS
+from .Metrics import METRICS
+from .Routing import CidrTable
+
+
+class TokenBucket:
+    #a bandwidth budget of rate bytes per second, shared by any number of transfers: each takes
+    #tokens for a chunk before moving it.  Tokens accumulate while unused, up to --burst seconds'
+    #worth.  A taker may overdraw the bucket; takers after it then wait until it is back in
+    #credit, and are served in turn, so transfers sharing the bucket get equal shares of it as
+    #long as they take no more than quantum bytes at a time
+    def __init__(self, rate):
+        self.rate = rate
+        self.burst = max(rate * OPTS.burst, 1.0)
+        self.quantum = max(4096, int(rate / 10))
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+        self.waiters = collections.deque()  #(nbytes, future), in order of arrival
+        self.timer = None
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    async def take(self, nbytes):
+        if not self.waiters:
+            self._refill()
+            if 0 < self.tokens:
+                self.tokens -= nbytes
+                return
+        fut = asyncio.get_event_loop().create_future()
+        self.waiters.append((nbytes, fut))
+        self._schedule()
+        start_time = time.monotonic()
+        try:
+            await fut
+        finally:
+            METRICS.throttled_seconds += time.monotonic() - start_time
+
+    def give_back(self, nbytes):
+        #return tokens taken for a chunk that turned out smaller
+        self.tokens = min(self.burst, self.tokens + nbytes)
+
+    def _schedule(self):
+        if self.timer is None and self.waiters:
+            delay = max(0.0, -self.tokens / self.rate) + 0.001
+            self.timer = asyncio.get_event_loop().call_later(delay, self._wake)
+
+    def _wake(self):
+        self.timer = None
+        self._refill()
+        while self.waiters and 0 < self.tokens:
+            nbytes, fut = self.waiters.popleft()
+            if not fut.done():  #its transfer may have been cancelled meanwhile
+                self.tokens -= nbytes
+                fut.set_result(None)
+        self._schedule()
+
+
+class Bandwidth:
+    #the budgets that transfers draw on: one for all data from upstream servers (--limit), and
+    #one per --client-limit for data sent to the clients within its CIDR.  With --workers, each
+    #process gets an equal part of every budget
+    def __init__(self):
+        self.upstream = TokenBucket(OPTS.limit / OPTS.workers) if OPTS.limit else None
+        self.clients = CidrTable((network, TokenBucket(rate / OPTS.workers))
+                                 for network, rate in OPTS.client_limit)
+
+    def downstream(self, ip):
+        #the budget for sending to the client at ip, or None if it has none
+        return self.clients.lookup(ip) if self.clients and ip else None
+
+
+async def take_all(buckets, nbytes):
+    #take nbytes from each of the (non-None) buckets limiting a transfer
+    for bucket in buckets:
+        if bucket is not None:
+            await bucket.take(nbytes)
+
+
+def give_back_all(buckets, nbytes):
+    for bucket in buckets:
+        if bucket is not None:
+            bucket.give_back(nbytes)
+
+
+def quantum(buckets, nbytes):
+    #the most a transfer limited by buckets should take at once, if it wants nbytes
+    for bucket in buckets:
+        if bucket is not None:
+            nbytes = min(nbytes, bucket.quantum)
+    return nbytes
+
+
+BANDWIDTH = Bandwidth()
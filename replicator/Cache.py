@@ -1,189 +1,839 @@
-import asyncio, logging, os, time
+import asyncio, fcntl, fnmatch, heapq, itertools, logging, os, time
 from .Params import OPTS
-from .Utils import header_summary, transfer_streams
+from .Bandwidth import BANDWIDTH
+from .Dedup import STORE
+from .DiskIO import DISK
+from .Failures import FAILURES, UpstreamFailure
+from .HotCache import HOT
+from .Index import INDEX
+from .Journal import JOURNAL
+from .Metrics import METRICS
+from .Utils import (ChunkSizer, multipart_headers, resolve_ranges, response_headers,
+                    transfer_streams)
+from .Variants import VARIANTS
+
+#errors signalling that a transport (e.g., SSL) can not sendfile(), so we must copy via userspace
+_NOSENDFILE = (NotImplementedError,
+               getattr(asyncio, 'SendfileNotAvailableError', NotImplementedError))
+
+#with --workers, the process fetching a file publishes its expected size and mtime in this xattr
+_XATTR = 'user.replicator.params'
+
+
+def _expiry_time(proto):
+    #upstream's own freshness information wins; failing that, the first matching --ttl applies
+    if proto.expires is not None:
+        return proto.expires
+    url = str(proto.url)
+    for pattern, ttl in OPTS.ttl:
+        if fnmatch.fnmatchcase(url, pattern):
+            return time.time() + ttl
+    return None  #revalidate on every request
+
+
+def _copy_prefix(src, dst, count):
+    #(runs on a disk thread) copy the first count bytes of file src to file dst
+    offset = 0
+    while offset < count:
+        block = os.pread(src, min(1 << 20, count - offset), offset)
+        if not block:
+            break
+        os.pwrite(dst, block, offset)
+        offset += len(block)
+
+
+class _Overtaken(Exception):
+    #a stream reached data that another stream of the same file has written already
+    pass
 
 
 class _CacheWriter:
-    def __init__(self, cacheobj, write_stream):
+    #batches upstream data into writes of at least OPTS.flushsize bytes; a timer bounds how long
+    #data of a slow transfer can sit in the batch before readers get to see it
+    def __init__(self, cacheobj, offset, end=None):
         self.cache = cacheobj
-        self.write_stream = write_stream
+        self.offset = offset  #where in the file the next batch goes
+        self.end = end  #where the stream ends, if known
+        self.chunks, self.pending = [], 0
+        self.timer = None
+        self.lock = asyncio.Lock()  #batches get written one at a time, in order
 
     async def write(self, chunk):
-        #we're not actually 'async', but transfer_streams() demands that we claim to be
-        self.write_stream.write(chunk)
-        self.write_stream.flush()  #readers have dup of underlying fd, but do not share the buffer
-        self.cache.cur_size += len(chunk)
-        self.cache.write_event.set()
+        self.chunks.append(chunk)
+        self.pending += len(chunk)
+        position = self.offset + self.pending
+        if position < self.cache.available(position):
+            await self.flush()
+            raise _Overtaken()  #the rest of the stream is on disk already
+        if OPTS.flushsize <= self.pending:
+            await self.flush()  #while the disk is busy, we stop reading from upstream
+        elif self.timer is None:
+            self.timer = asyncio.get_event_loop().call_later(OPTS.flushtime, self._flush_later)
+
+    def _flush_later(self):
+        self.timer = None
+        asyncio.ensure_future(self.flush(True))
+
+    async def flush(self, from_timer=False):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        chunks = self.chunks
+        self.chunks, self.pending = [], 0
+        async with self.lock:  #even with nothing to write, wait for any write in progress
+            if not chunks:
+                return
+            #write at an explicit offset: readers hold dups of the fd, which share its position
+            view = memoryview(b''.join(chunks))
+            start = self.offset
+            while view:
+                nbytes = await DISK.call(self.cache.dev, os.pwrite, self.cache.writer_fd, view,
+                                         self.offset)
+                self.offset += nbytes
+                view = view[nbytes:]
+        self.cache.fill(start, self.offset)
+        METRICS.upstream_bytes += self.offset - start
+        #a timer-driven flush means the transfer is slow; then wake every reader with new data
+        self.cache.notify_readers(eager=from_timer)
 
 
 class Cache:
+    MAX_DEMANDS = 4  #range fetches on behalf of readers, per file at a time
+
     def __init__(self, path):
         self.filepath = path
         self.temppath = None
         self.is_valid = False
         self.is_writable = False
         self.wrier_done = False
-        self.cur_size = 0
+        self.eof = False  #no more data is coming; target_size is final, unless failed
+        self.failed = False  #the file ended short of its size, see _end_stream()
+        self.failure = None  #the exception that the writer failed with, for its readers
+        self.revoked = None  #the status (403, 404 or 410) upstream revoked the file with
+        self.cur_size = 0  #length of the part of the file, from its start, that is on disk
+        self.extents = []  #further [start, end) ranges on disk, beyond cur_size (sorted, disjoint)
+        self.segmented = False  #whether parts of the file are being fetched in parallel
+        self.fetchers = set()  #_CacheWriters of the streams from upstream in progress
+        self.demands = set()  #tasks of range fetches started for readers, see _demand()
+        self.proto = None  #while being fetched, if the rest of the file can be fetched by range
+        self.readers = 0  #number of clients being served from this entry
         self.target_mtime = None
         self.target_size = None
         self.writer_fd = None
+        self.dev = DISK.root_dev  #device holding the file, once it is open
+        self.shared_fd = None  #a hardlinked file being replaced by a copy, see _unshare()
+        self.journal = None  #the JOURNAL entry of a large download in progress
+        self.journal_lock = asyncio.Lock()  #entry updates are written one at a time, in order
         self.have_params = asyncio.Event()  #let readers know they have enough valid info to start
-        self.write_event = asyncio.Event()  #allow any readers waiting on cur_size growth to retry
-        self.write_done = asyncio.Event()  #XXX hack to work-around a mystery "cancel"laton
+        self.waiters = []  #heap of readers waiting for cur_size to reach a given offset
+        self.waiter_seq = itertools.count()  #tie-breaker, so the heap never compares futures
+        self.write_done = asyncio.Event()  #set once the writer is done, whatever the outcome
         logging.debug('Instantiated cache position %s', self.filepath)
 
     def __del__(self):
         if self.writer_fd is not None:
             os.close(self.writer_fd)
 
-    def _tryopen(self, path, mode):
+    async def _tryopen(self, path, mode):
         try:
-            return os.open(path, mode)
+            return await DISK.path_call(os.open, path, mode)
         except:
             return None
 
-    def _tryremove(self, path):
+    async def _tryremove(self, path):
         try:
-            os.remove(path)
+            await DISK.path_call(os.remove, path)
             return True
         except:
             return None
 
-    def _open_cachefile(self):
+    async def _open_cachefile(self):
         logging.debug('Preparing cache file %s', self.filepath)
         if OPTS.static or OPTS.offline:
-            fd = self._tryopen(self.filepath, os.O_RDONLY)
+            fd = await self._tryopen(self.filepath, os.O_RDONLY)
             if fd is not None:
                 logging.info('Serving static file directly from cache')
                 return fd
         assert not OPTS.offline, f'operating in off-line mode'
         self.is_writable = True
         temppath = self.filepath + OPTS.suffix
-        dir_path = os.path.dirname(temppath)
-        if dir_path:
-            os.makedirs(dir_path, exist_ok=True)
-        fd = self._tryopen(temppath, os.O_RDWR)
-        if fd is not None:
-            logging.debug('Requesting resume of partial file in cache')
-            self.temppath = temppath
-            return fd
-        fd = self._tryopen(self.filepath, os.O_RDWR)
-        if fd is not None:
-            logging.debug('Reading complete file from cache')
+        #the index tells us which of the complete or partial file to look for first; it is only
+        #a hint, so the other is tried too (and the writer sets the entry right once it is open)
+        entry = INDEX.get(self.filepath)
+        paths = [self.filepath, temppath] if entry and entry.complete else [temppath, self.filepath]
+        for path in paths:
+            fd = await self._tryopen(path, os.O_RDWR)
+            if fd is None:
+                continue
+            if path == temppath:
+                logging.debug('Requesting resume of partial file in cache')
+                self.temppath = temppath
+            else:
+                logging.debug('Reading complete file from cache')
             return fd
         logging.debug('Preparing new file in cache')
         self.temppath = temppath
-        return os.open(temppath, os.O_RDWR | os.O_CREAT, mode=0o666)
+        dir_path = os.path.dirname(temppath)
+        if dir_path not in INDEX.dirs:
+            await DISK.path_call(INDEX.makedirs, dir_path)
+        try:
+            return await DISK.path_call(os.open, temppath, os.O_RDWR | os.O_CREAT, 0o666)
+        except FileNotFoundError:
+            #directory was removed behind our back
+            await DISK.path_call(INDEX.makedirs, dir_path, True)
+            return await DISK.path_call(os.open, temppath, os.O_RDWR | os.O_CREAT, 0o666)
 
     async def writer(self, proto):
         try:
             assert self.writer_fd is None, 'invalid second call to .writer within an instance of Cache'
-            self.writer_fd = self._open_cachefile()
-            stat = os.stat(self.writer_fd)
+            open_time = time.monotonic()
+            self.writer_fd = await self._open_cachefile()
+            stat = await DISK.path_call(os.stat, self.writer_fd)
+            METRICS.open_time.observe(time.monotonic() - open_time)
+            self.dev = stat.st_dev
             self.cur_size = self.target_size = stat.st_size
+            params = self._get_params() if self.temppath else None
+            if params and params[2] is not None:
+                #an interrupted segmented download: only its prefix is known to be free of holes
+                self.cur_size = min(self.cur_size, params[2])
             self.target_mtime = stat.st_mtime if self.temppath is None else None
+            entry = INDEX.update(self.filepath, self.cur_size, self.target_mtime,
+                                 self.temppath is None)
             if not self.is_writable:
+                METRICS.hits += 1
                 self.is_valid = True
+                await self._on_complete(proto)
                 return  #read-only cache - do not make an inquiry against the upstream server
-            proto_generator = proto.fetch(self.cur_size, self.target_mtime)
-            proto_tuple = await proto_generator.__anext__()
+            if entry.is_fresh():
+                logging.info('Serving fresh file directly from cache')
+                METRICS.hits += 1
+                self.is_valid = True
+                await self._on_complete(proto)
+                return  #validated recently enough - no need to ask the upstream server again
+            if 1 < OPTS.workers:
+                if not self._trylock():
+                    METRICS.merges += 1
+                    await self._follow()
+                    return  #another worker process is fetching this file
+                self._publish_params(clear=True)  #in case a previous fetch left some behind
+            if self.temppath and self.cur_size:
+                #resume only if upstream still has what we have the start of
+                entry = await DISK.path_call(JOURNAL.read, self.filepath)
+                if entry and entry['validator'] and hasattr(proto, 'validator'):
+                    proto.validator = entry['validator']
+            try:
+                proto_generator, proto_tuple = await self._ask_upstream(proto)
+            except UpstreamFailure as e:
+                if self.temppath is None:  #better a file that may be out of date than none
+                    logging.warning('Serving file from cache without revalidation (%s)', e)
+                    METRICS.stale += 1
+                    self.is_valid = True
+                    return
+                raise
             if proto_tuple is None:
                 #revoke any cached file, and bail out
-                if self._tryremove(self.filepath):
+                METRICS.revocations += 1
+                self.revoked = getattr(proto, 'status', None) or 404
+                FAILURES.remember(self.filepath, self.revoked,
+                                  f'{proto.url} revoked upstream ({self.revoked})')
+                HOT.discard(self.filepath)
+                await VARIANTS.discard(self.filepath)
+                if await self._tryremove(self.filepath):
                     logging.debug('Removed revoked file "%s" from cache', self.filepath)
                 if self.temppath:
-                    self._tryremove(self.temppath)
+                    await self._tryremove(self.temppath)
+                INDEX.discard(self.filepath)
+                await JOURNAL.end(self.filepath)
                 return
             cur_pos, self.target_size, mtime, read_stream = proto_tuple
+            if read_stream:
+                METRICS.misses += 1
+                HOT.discard(self.filepath)  #whatever it holds is about to be replaced
+                await VARIANTS.discard(self.filepath)
+            else:
+                METRICS.revalidations += 1
             if cur_pos is not None:
                 self.cur_size = min(cur_pos, self.cur_size)
             if mtime is not None:
                 self.target_mtime = mtime
+            if read_stream and self.temppath is None and await self._shared():
+                await self._unshare()
+            if read_stream and self.cur_size == 0 and await self._link_stored(proto):
+                read_stream = None
             if self.cur_size == 0:
                 logging.debug('Preparing new file in cache')
-            with open(self.writer_fd, 'r+b', closefd=False) as write_stream:
-                write_stream.seek(self.cur_size)
-                write_stream.truncate()
-                self.is_valid = True
-                self.have_params.set()  #release reader tasks to start tracking data updates
-                if read_stream:
-                    await transfer_streams(read_stream, _CacheWriter(self, write_stream))
+            await DISK.call(self.dev, os.ftruncate, self.writer_fd, self.cur_size)
+            segments = self._plan_segments(proto) if read_stream else []
+            self.segmented = 1 < len(segments)
+            if read_stream and self.target_size is not None and getattr(proto, 'validator', None):
+                self.proto = proto  #readers far ahead of the download may fetch by range
+            if read_stream and self.temppath and JOURNAL.CHECKPOINT <= (self.target_size
+                                                                       or JOURNAL.CHECKPOINT):
+                self.journal = await JOURNAL.begin(self.filepath, proto, self.target_size,
+                                                   self.cur_size)
+            self._publish_params()
+            self.is_valid = True
+            #release reader tasks to start tracking data updates; from here on, no awaits until
+            #the streams from upstream are in self.fetchers, or readers would _demand() them anew
+            self.have_params.set()
+            if self.segmented:
+                await self._fetch_segments(proto, read_stream, segments)
+            elif read_stream:
+                await self._store(read_stream, self.cur_size, self.target_size,
+                                  'Upstream to cache')
+            if self.proto is not None:
+                await self._fill_gaps()
+            self._end_stream(self.target_size is None or self.cur_size == self.target_size)
             if self.target_mtime is not None:
-                os.utime(self.writer_fd, (self.target_mtime, self.target_mtime))
-            if self.cur_size == self.target_size or self.target_size is None:
+                mtimes = (self.target_mtime, self.target_mtime)
+                await DISK.call(self.dev, os.utime, self.writer_fd, mtimes)
+            if self.cur_size == self.target_size:
                 if self.temppath:
-                    os.rename(self.temppath, self.filepath)
+                    await DISK.call(self.dev, os.rename, self.temppath, self.filepath)
+                    self.temppath = None
                 logging.info('Cached complete file: %s', self.filepath)
             else:
                 logging.info('Incomplete download for %s', self.filepath)
+            INDEX.update(self.filepath, self.cur_size, self.target_mtime, self.temppath is None,
+                         validated=True, expires=_expiry_time(proto))
+            await self._on_complete(proto)
             async for _ in proto_generator:
                 #give proto the  ability to clean-up after data transfer
                 pass
+        except Exception as e:
+            self.failure = e
+            raise
         finally:
+            self.proto = None
+            for task in self.demands:
+                task.cancel()
+            if self.demands:
+                await asyncio.gather(*self.demands, return_exceptions=True)
+            if self.extents:
+                #do not leave holes in the file: on resume, we continue from its end
+                await DISK.call(self.dev, os.ftruncate, self.writer_fd, self.cur_size)
+                self.extents = []
+            if self.journal is not None:
+                await self._end_journal()
+            if 1 < OPTS.workers and self.writer_fd is not None:
+                fcntl.flock(self.writer_fd, fcntl.LOCK_UN)  #let other workers use the file again
+            if self.shared_fd is not None:
+                os.close(self.shared_fd)
+                self.shared_fd = None
             #notify any reader tasks that any further blocking on data will be futile
+            self._end_stream(self.temppath is None)
             self.wrier_done = True
             self.have_params.set()  #failsafe, in case not otherwise called
-            self.write_event.set()
-            self.write_done.set()  #XXX hack
+            self.write_done.set()
+
+    async def _ask_upstream(self, proto):
+        #start proto.fetch(), and return it with its first item; raises UpstreamFailure if the
+        #upstream server fails to answer, or is not to be asked at all (see Failures.py)
+        upstream = proto.url.host, proto.url.port
+        if not FAILURES.allow(upstream):
+            raise UpstreamFailure(
+                503, f'upstream {upstream[0]}:{upstream[1]} is failing, not asking it again for '
+                f'{FAILURES.retry_time(upstream):.0f} seconds')
+        proto_generator = proto.fetch(self.cur_size, self.target_mtime)
+        try:
+            proto_tuple = await proto_generator.__anext__()
+        except asyncio.CancelledError as e:
+            FAILURES.finished(upstream, e)
+            raise
+        except Exception as e:
+            FAILURES.finished(upstream, e)
+            failure = UpstreamFailure(FAILURES.status(e), f'failed to fetch {proto.url} ({e})')
+            if self.temppath is not None:  #else the complete file gets served, see writer()
+                FAILURES.remember(self.filepath, failure.status, str(failure))
+            raise failure from e
+        FAILURES.finished(upstream)
+        if proto_tuple is not None:
+            FAILURES.forget(self.filepath)
+        return proto_generator, proto_tuple
+
+    def _end_stream(self, complete):
+        #signal the end of the data to readers, as soon as it is on disk (they need not wait for
+        #us to tidy up): a complete file now has a known size, even if upstream did not say;
+        #an incomplete one makes readers cut their clients off, rather than end their responses
+        #as if they had all of it
+        if self.eof:
+            return
+        self.eof, self.failed = True, not complete
+        if complete and self.target_size is None:
+            self.target_size = self.cur_size
+        self.notify_readers()
+
+    async def _on_complete(self, proto):
+        #keep a copy of a small, complete file in memory, for HOT to serve while it is fresh, and
+        #have compressed variants made of it, if wanted
+        if self.temppath is not None:
+            return
+        if HOT.wants(self.cur_size):
+            body = await DISK.pread(self.dev, self.writer_fd, self.cur_size, 0)
+            if len(body) == self.cur_size:
+                HOT.put(self.filepath, bytes(body), self.target_mtime)
+        VARIANTS.schedule(self.filepath, proto.url, self.cur_size, self.target_mtime)
+        STORE.schedule(self.filepath, self.cur_size, self.target_mtime)
+
+    async def _shared(self):
+        #whether the complete file is (or is about to be) a hardlink to a stored one
+        if STORE.busy(self.filepath):
+            return True
+        return 1 < (await DISK.path_call(os.stat, self.writer_fd)).st_nlink
+
+    async def _unshare(self):
+        #a complete file may be a hardlink to a stored one (see --dedup), which must not change in
+        #place: carry on in a copy of what we keep of it instead.  The old file stays open (and
+        #locked) until the new one replaces it.
+        temppath = self.filepath + OPTS.suffix
+        fd = await DISK.path_call(os.open, temppath, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o666)
+        await DISK.call(self.dev, _copy_prefix, self.writer_fd, fd, self.cur_size)
+        self.shared_fd, self.writer_fd, self.temppath = self.writer_fd, fd, temppath
+        if 1 < OPTS.workers:
+            self._trylock()
+
+    async def _link_stored(self, proto):
+        #with --dedup, upstream may tell us the digest of a file that we have stored already, for
+        #another url: link to that instead of downloading it again
+        if not OPTS.dedup or proto.digest is None or self.target_mtime is None:
+            return False
+        path = await DISK.path_call(STORE.lookup, proto.digest, self.target_size,
+                                    self.target_mtime)
+        if path is None:
+            return False
+        try:
+            await DISK.path_call(STORE.link, path, self.filepath)
+        except OSError as e:
+            logging.warning('Failed to link %s to stored file (%s)', self.filepath, e)
+            return False
+        fd = await self._tryopen(self.filepath, os.O_RDWR)
+        if fd is None:
+            return False
+        if self.temppath:
+            await self._tryremove(self.temppath)
+        os.close(self.writer_fd)
+        self.writer_fd, self.temppath = fd, None
+        self.cur_size = self.target_size = os.fstat(fd).st_size
+        METRICS.dedup_bytes += self.cur_size
+        logging.info('Linked %s to an identical stored file', self.filepath)
+        return True
+
+    def _plan_segments(self, proto):
+        #split the rest of the file into up to --segments parts of at least --segment-size bytes,
+        #if the upstream server lets us fetch those separately; otherwise, it is all one part
+        start, end = self.cur_size, self.target_size
+        if end is None or not getattr(proto, 'validator', None):
+            return [(start, end)]
+        count = min(OPTS.segments, (end - start) // OPTS.segment_size)
+        if count < 2:
+            return [(start, end)]
+        step = -(-(end - start) // count)
+        bounds = [start + i * step for i in range(count)] + [end]
+        return list(zip(bounds, bounds[1:]))
 
-    async def reader(self, responder, downstream, start_offset=0, end_offset=None):
+    async def _fetch_segments(self, proto, read_stream, segments):
+        #the initial response supplies the first segment, and range requests the others, all at
+        #the same time
+        logging.info('Fetching %s in %d segments', self.filepath, len(segments))
+        (start, end), others = segments[0], segments[1:]
+        tasks = [asyncio.ensure_future(self._fetch_segment(proto, self._fetcher(*seg)))
+                 for seg in others]
+        try:
+            await self._store(read_stream, start, end, 'Upstream to cache')
+        except:
+            for task in tasks:
+                task.cancel()
+            raise
+        finally:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _fetcher(self, start, end):
+        #the _CacheWriter for a range fetch of [start, end), registered at once, so that _demand()
+        #knows that the fetch is coming before its task gets to run
+        cache_writer = _CacheWriter(self, start, end)
+        self.fetchers.add(cache_writer)
+        return cache_writer
+
+    async def _fetch_segment(self, proto, cache_writer):
+        #a failed segment is not fatal: it leaves a gap, which _fill_gaps() tries once more
+        start, end = cache_writer.offset, cache_writer.end
+        try:
+            async for read_stream in proto.fetch_range(start, end):
+                if read_stream is None:
+                    logging.warning('Upstream refused segment %d-%d of %s', start, end - 1,
+                                    self.filepath)
+                else:
+                    await self._store(read_stream, start, end, f'Segment at {start}',
+                                      cache_writer)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.warning('Failed to fetch segment %d-%d of %s (%s)', start, end - 1,
+                            self.filepath, e)
+        finally:
+            self.fetchers.discard(cache_writer)
+
+    async def _store(self, read_stream, start, end, name, cache_writer=None):
+        #copy a stream from upstream to [start, end) of the file, or up to wherever it ends if end
+        #is None, stopping short at data that another stream has written already
+        if cache_writer is None:
+            cache_writer = _CacheWriter(self, start, end)
+        self.fetchers.add(cache_writer)
+        try:
+            await transfer_streams(read_stream, cache_writer, name,
+                                   None if end is None else end - start)
+        except _Overtaken:
+            logging.debug('%s reached data already in cache at %d', name, cache_writer.offset)
+        finally:
+            await cache_writer.flush()
+            self.fetchers.discard(cache_writer)
+
+    def _demand(self, offset):
+        #a reader waits for data at offset: unless a stream from upstream is about to get there,
+        #fetch the file from there on, in parallel with the rest of the download
+        if self.proto is None or self.target_size <= offset or self.MAX_DEMANDS <= len(
+                self.demands):
+            return
+        for fetcher in self.fetchers:
+            if 0 <= offset - fetcher.offset <= OPTS.segment_size and offset < fetcher.end:
+                return  #that stream gets there soon enough
+        end = next((lo for lo, hi in self.extents if offset < lo), self.target_size)
+        logging.info('Fetching %s from %d, where a reader waits', self.filepath, offset)
+        METRICS.demand_fetches += 1
+        self.segmented = True  #the file will have holes for a while
+        self._publish_params()
+        task = asyncio.ensure_future(self._fetch_segment(self.proto, self._fetcher(offset, end)))
+        self.demands.add(task)
+        task.add_done_callback(self.demands.discard)
+
+    def _next_gap(self):
+        #the first [start, end) of the file that is neither on disk nor being fetched, or None
+        start = self.cur_size
+        covered = sorted([[lo, hi] for lo, hi in self.extents] +
+                         [[f.offset, f.end] for f in self.fetchers])
+        for lo, hi in covered:
+            if start < lo:
+                return start, lo
+            start = max(start, hi)
+        return (start, self.target_size) if start < self.target_size else None
+
+    async def _fill_gaps(self):
+        #streams stop where they meet data written by others, and fetches on demand start ahead
+        #of the rest: fetch whatever they leave out, until the file is complete
+        while True:
+            gap = self._next_gap()
+            if gap is None:
+                if not self.demands:
+                    return
+                await asyncio.wait(list(self.demands))
+                continue
+            filled = self.cur_size + sum(hi - lo for lo, hi in self.extents)
+            await self._fetch_segment(self.proto, self._fetcher(*gap))
+            if filled == self.cur_size + sum(hi - lo for lo, hi in self.extents):
+                return  #upstream will not let us have it: the download stops short of the gap
+
+    def fill(self, start, end):
+        #record that [start, end) of the file has been written
+        prefix = self.cur_size
+        ranges = sorted(self.extents + [[start, end]])
+        self.extents = []
+        for lo, hi in ranges:
+            if lo <= self.cur_size:
+                self.cur_size = max(self.cur_size, hi)
+            elif self.extents and lo <= self.extents[-1][1]:
+                self.extents[-1][1] = max(self.extents[-1][1], hi)
+            else:
+                self.extents.append([lo, hi])
+        INDEX.resize(self.filepath, self.cur_size + sum(hi - lo for lo, hi in self.extents))
+        if self.journal and self.journal['confirmed'] + JOURNAL.CHECKPOINT <= self.cur_size and (
+                not self.journal_lock.locked()):
+            asyncio.ensure_future(self._checkpoint())
+        if self.segmented and self.cur_size != prefix:
+            self._publish_params()  #for followers, and for resuming after a crash
+
+    async def _checkpoint(self):
+        #make what we have of the file durable, then let the journal know how much that is
+        async with self.journal_lock:
+            entry, confirmed = self.journal, self.cur_size
+            if entry is None or confirmed <= entry['confirmed']:
+                return
+            try:
+                await DISK.call(self.dev, os.fdatasync, self.writer_fd)
+                await JOURNAL.confirm(entry, confirmed)
+            except OSError as e:
+                logging.warning('Failed to record progress of %s (%s)', self.filepath, e)
+
+    async def _end_journal(self):
+        #a complete file needs no journal entry; an incomplete one keeps it, for resuming later
+        if self.temppath is None:
+            async with self.journal_lock:
+                self.journal = None
+                await JOURNAL.end(self.filepath)
+        else:
+            await self._checkpoint()
+            self.journal = None
+
+    def available(self, offset):
+        #end of the written range of the file that offset lies in; offset itself, if unwritten
+        if offset < self.cur_size:
+            return self.cur_size
+        for lo, hi in self.extents:
+            if lo <= offset < hi:
+                return hi
+        return offset
+
+    def _trylock(self):
+        #with --workers, whoever holds this lock is the only process writing to the file
+        try:
+            fcntl.flock(self.writer_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            return False
+
+    def _publish_params(self, clear=False):
+        try:
+            if clear:
+                os.removexattr(self.writer_fd, _XATTR)
+            else:
+                #segmented downloads leave holes in the file, so also say how much has no holes
+                prefix = self.cur_size if self.segmented else None
+                params = f'{self.target_size} {self.target_mtime} {prefix}'.encode()
+                os.setxattr(self.writer_fd, _XATTR, params)
+        except (AttributeError, OSError):
+            pass  #no xattr support; followers will have to stream without knowing the length
+
+    def _get_params(self):
+        #returns the published (size, mtime, prefix), or None
+        try:
+            fields = os.getxattr(self.writer_fd, _XATTR).decode().split()
+            size, mtime, prefix = (None if field == 'None' else float(field) for field in fields)
+        except (AttributeError, OSError, ValueError):
+            return None
+        return None if size is None else int(size), mtime, None if prefix is None else int(prefix)
+
+    def _read_params(self):
+        params = self._get_params()
+        if params is None:
+            return False
+        self.target_size, self.target_mtime, _ = params
+        return True
+
+    def _sync_size(self):
+        size = os.fstat(self.writer_fd).st_size
+        params = self._get_params()
+        if params and params[2] is not None:
+            size = min(size, params[2])  #the fetching worker is downloading segments
+        if size != self.cur_size:
+            self.cur_size = size
+            self.notify_readers(eager=True)
+
+    async def _follow(self):
+        #another worker process holds the lock on this file, so is fetching it: rather than fetch
+        #it a second time, track the growth of the file until that worker lets go of it
+        logging.debug('Following download of %s by another worker process', self.filepath)
+        have_lock = False
+        while not have_lock and (self.temppath is None or not self._read_params()):
+            await asyncio.sleep(OPTS.flushtime)  #complete files: wait out their revalidation
+            have_lock = self._trylock()
+        if os.fstat(self.writer_fd).st_nlink == 0:
+            INDEX.discard(self.filepath)
+            return  #the file got revoked
+        self.is_valid = True
+        self.have_params.set()
+        while not have_lock:
+            self._sync_size()
+            await asyncio.sleep(OPTS.flushtime)
+            have_lock = self._trylock()
+        self._sync_size()
+        if self.temppath is None or not os.path.exists(self.temppath):
+            self.target_size = self.cur_size  #the other worker completed the file
+            self.temppath = None
+        INDEX.update(self.filepath, self.cur_size, self.target_mtime, self.temppath is None)
+
+    def notify_readers(self, eager=False):
+        #wake the readers whose wanted offset has been written (all of them, once the writer is
+        #done); if eager, also wake those for which any new data at all is available
+        while self.waiters and (self.eof or self.waiters[0][0] <= self.cur_size):
+            fut = heapq.heappop(self.waiters)[-1]
+            if not fut.done():
+                fut.set_result(None)
+        if eager or self.extents:
+            #the rest wait beyond cur_size, where segments of the file may also be written
+            waiting = []
+            for waiter in self.waiters:
+                wanted, cursor, fut = waiter[0], waiter[1], waiter[-1]
+                available = self.available(cursor)
+                if (wanted <= available or eager and cursor < available) and not fut.done():
+                    fut.set_result(None)
+                elif not fut.done():
+                    waiting.append(waiter)
+            heapq.heapify(waiting)
+            self.waiters = waiting
+
+    async def _wait_for_data(self, cursor, wanted):
+        #block until data beyond cursor is on disk; ideally up to wanted, so we do not get woken
+        #for every little write
+        if self.available(cursor) <= cursor and not self.eof:
+            self._demand(cursor)
+            fut = asyncio.get_event_loop().create_future()
+            waiter = (max(wanted, cursor + 1), cursor, next(self.waiter_seq), fut)
+            heapq.heappush(self.waiters, waiter)
+            await fut
+
+    async def _sendfile(self, downstream, stream, offset, count):
+        #hand [offset, offset+count) of the cache file straight to the kernel; returns False
+        #(having sent nothing) if the transport or python version can not do so
+        loop = asyncio.get_event_loop()
+        if not hasattr(loop, 'sendfile'):  #python < 3.7
+            return False
+        try:
+            await loop.sendfile(downstream.transport, stream, offset, count, fallback=False)
+        except _NOSENDFILE:
+            return False
+        return True
+
+    async def reader(self, responder, downstream, ranges=None, encodings=None):
+        #encodings: those of VARIANTS.accepted() by the client, or None if the file is not one
+        #to have compressed variants
+        self.readers += 1
+        try:
+            await self._serve(responder, downstream, ranges, encodings)
+        finally:
+            self.readers -= 1
+
+    def _spans(self, ranges):
+        #the [start, end) spans of the file to serve for ranges (as from parse_ranges), or None
+        #for all of it.  A single range from a given offset is served as before, even before the
+        #size is known (its end is cut back to the size once that is known); others can only be
+        #resolved against the size, without which we serve all
+        if not ranges:
+            return None
+        if len(ranges) == 1 and 0 <= ranges[0][0]:
+            start, end = ranges[0]
+            if end is not None and self.target_size is not None:
+                end = min(end, self.target_size)
+            return [(start, end)]
+        if self.target_size is None:
+            return None
+        return resolve_ranges(ranges, self.target_size)
+
+    async def _serve(self, responder, downstream, ranges, encodings):
         await self.have_params.wait()  #wait for writer to report-out the available upstream range
         if not self.is_valid:
+            if self.failure is not None:
+                raise self.failure  #joined clients learn what the first one does
             return  #writer does not indicate this entry as valid
+        INDEX.touch(self.filepath)
+        sizer = ChunkSizer('Cache to client')
+        if encodings is not None:
+            responder.headers.update({'Vary': 'Accept-Encoding'})
+            if encodings and not ranges and await self._serve_variant(responder, downstream,
+                                                                      encodings, sizer):
+                return
         stream = open(os.dup(self.writer_fd), 'rb')
-        end = end_offset
-        if end is None and self.target_size:
-            end = self.target_size
-        start = min((start_offset or 0), (end or 0))
-        while self.cur_size < start and not self.wrier_done:
-            self.write_event.clear()  #wait for writer to get us closer to the starting offset
-            await self.write_event.wait()
-        if self.target_mtime is not None:
-            mtime_str = time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime(self.target_mtime))
-            responder.headers.update({'Last-Modified': mtime_str})
-        responder.headers.update({'Server': OPTS.version})
-        if end is not None and end <= start:
-            responder.headers.update({'Content-Range': f'*/{self.target_size or end}'})
-            status = 304 if end == start else 416
-            responder.set_status(status)
-        elif (start, end) == (0, self.target_size):
-            if self.target_size is not None:
-                responder.headers.update({'Content-Length': str(self.target_size)})
-            responder.set_status(200)
-            logging.debug('Replicator responds 200 OK')
+        spans = self._spans(ranges)
+        if spans is not None and len(spans) != 1:
+            heads, tail = multipart_headers(responder, spans, self.target_size, self.target_mtime)
+            await responder.prepare(downstream)
+            for head, (start, end) in zip(heads, spans):
+                #each part waits for its own data only, however far into the file it lies
+                await responder.write(head)
+                await self._send(responder, downstream, stream, sizer, start, end)
+            if tail:
+                await responder.write(tail)
         else:
-            if self.target_size is not None:
-                tsz = self.target_size
-                if end:
-                    responder.headers.update({'Content-Range': f'{start}-{end-1}/{tsz}'})
-                else:
-                    responder.headers.update({'Content-Range': f'{start}-/{tsz}'})
-            if end:
-                responder.headers.update({'Content-Length': str(end - start)})
-            responder.set_status(206)
-            logging.debug('Replicator responds 206 Partial Content')
-        if OPTS.verbose > 1:
-            logging.debug('%s', header_summary(responder.headers, heading='Response headers:'))
-        #note that we are ignoring any GET content body that the client was odd enough to send...
-        await responder.prepare(downstream)
+            start_offset, end_offset = spans[0] if spans else (0, None)
+            end = end_offset
+            if end is None and self.target_size:
+                end = self.target_size
+            start = min((start_offset or 0), (end or 0))
+            if self.available(start - 1) < start:  #wait for writer to get us to the starting offset
+                await self._wait_for_data(start - 1, start)
+            response_headers(responder, start, end, self.target_size, self.target_mtime)
+            #note that we ignore any GET content body that the client was odd enough to send...
+            await responder.prepare(downstream)
+            await self._send(responder, downstream, stream, sizer, start, end)
+        #the client need not wait for the rest of the download, once it has what it asked for
+        await responder.write_eof()
+        sizer.report()
+        logging.debug('Successfully transferred %s', self.filepath)
+
+    async def _serve_variant(self, responder, downstream, encodings, sizer):
+        #serve a compressed variant of a complete file, if it has one the client accepts
+        if self.temppath is not None or self.target_mtime is None:
+            return False
+        variant = await VARIANTS.lookup(self.filepath, encodings, self.target_mtime)
+        try:
+            fd = variant and await DISK.path_call(os.open, variant[0], os.O_RDONLY)
+        except OSError:
+            fd = None  #removed behind our back
+        if not fd:
+            return False
+        path, encoding, size = variant
+        try:
+            logging.debug('Serving %s variant of %s', encoding, self.filepath)
+            responder.headers.update({'Content-Encoding': encoding})
+            response_headers(responder, 0, size, size, self.target_mtime)
+            await responder.prepare(downstream)
+            await self._send(responder, downstream, open(os.dup(fd), 'rb'), sizer, 0, size, fd)
+            await responder.write_eof()
+        finally:
+            os.close(fd)
+        sizer.report()
+        logging.debug('Successfully transferred %s', path)
+        return True
+
+    async def _send(self, responder, downstream, stream, sizer, start, end, fd=None):
+        #copy [start, end) of the file to the client (up to wherever the download ends, if end is
+        #None), as it becomes available; fd, if given, is that of a variant of the complete file
+        fd = self.writer_fd if fd is None else fd
+        bucket = BANDWIDTH.downstream(downstream.remote)  #the client's --client-limit, if any
+        #zero-copy is only possible when the body is neither chunk-encoded nor compressed:
+        use_sendfile = OPTS.sendfile and end is not None
         cursor = start
-        while end is None or cursor < end:
-            while self.cur_size <= cursor:
-                #we've outrun the writer; wait for more data to show up
-                if self.wrier_done:
-                    break
-                self.write_event.clear()
-                await self.write_event.wait()
+        while True:
+            if self.eof and not self.failed:
+                #the size is final now: a response of unknown length ends there
+                end = self.target_size if end is None else min(end, self.target_size)
+            if end is not None and end <= cursor:
+                break
+            if self.available(cursor) <= cursor:
+                if self.eof:
+                    raise AssertionError(f'download of {self.filepath} stopped short at {cursor}')
+                #we've outrun the writer; wait for a worthwhile amount of new data to show up
+                wanted = cursor + max(sizer.size, OPTS.flushsize)
+                await self._wait_for_data(cursor, wanted if end is None else min(wanted, end))
+                continue
+            if use_sendfile:
+                #in windows, so that each can be read into the page cache beforehand
+                count = min(self.available(cursor), end, cursor + DISK.PREFETCH) - cursor
+                if count > 0:
+                    if bucket is not None:
+                        count = min(count, bucket.quantum)
+                        await bucket.take(count)
+                    await DISK.prefetch(self.dev, fd, cursor, count)
+                    use_sendfile = await self._sendfile(downstream, stream, cursor, count)
+                    if use_sendfile:
+                        cursor += count
+                        METRICS.downstream_bytes += count
+                        continue
+                    logging.debug('Transport can not sendfile(); falling back to buffered copy')
             while True:
-                stream.seek(cursor)  #re-synchronize buffer with its underlying file
-                n = OPTS.maxchunk if end is None else min(OPTS.maxchunk, end - cursor)
-                chunk = stream.read(n) if n > 0 else None
+                start_time = time.time()
+                #never read past written data: with segments, the file can have holes
+                n = min(sizer.size, self.available(cursor) - cursor)
+                if end is not None:
+                    n = min(n, end - cursor)
+                if bucket is not None and n > 0:
+                    n = min(n, bucket.quantum)
+                    await bucket.take(n)
+                chunk = await DISK.pread(self.dev, fd, n, cursor) if n > 0 else None
+                if bucket is not None and n > 0 and len(chunk) < n:
+                    bucket.give_back(n - len(chunk))
                 if not chunk:
+                    assert n <= 0, f'{self.filepath} got truncated behind our back'
                     break
                 cursor += len(chunk)
-                if end is not None and cursor >= end:  #XXX hack
-                    await self.write_done.wait()  #XXX  hack
                 await responder.write(chunk)
-            if self.wrier_done:
-                break  #no more data will be forthcoming
-        logging.debug('Successfully transferred %s', self.filepath)
+                METRICS.downstream_bytes += len(chunk)
+                sizer.update(len(chunk), time.time() - start_time)
@@ -0,0 +1,188 @@
+import asyncio, base64, concurrent.futures, hashlib, logging, os, re
+from .Params import OPTS
+from .DiskIO import DISK
+from .Metrics import METRICS
+
+#the sha256 digest of a stored file, kept on its inode (so shared by all links to it)
+_XATTR = 'user.replicator.sha256'
+
+
+def upstream_digest(headers):
+    #the sha256 digest, in hex, that a Repr-Digest (RFC 9530) or Digest (RFC 3230) header gives
+    #for the body, or None
+    for name, pattern in ('repr-digest', r'sha-256=:([^:]+):'), ('digest', r'sha-256=([^,\s]+)'):
+        match = re.search(pattern, headers.get(name, ''), re.IGNORECASE)
+        if match:
+            try:
+                return base64.b64decode(match.group(1), validate=True).hex()
+            except ValueError:
+                pass
+    return None
+
+
+class ObjectStore:
+    #with --dedup, complete cache files are hashed (on a thread of their own) and stored once by
+    #their sha256 digest below DIR; a cache file with the same content as a stored one becomes a
+    #hardlink to it.  Only files that agree on mtime too are linked, since the mtime is also the
+    #Last-Modified date of every cacheid linked to the file.  Stored files which nothing else
+    #links to any more are removed by sweep().
+    DIR = '.objects'
+    MIN_SIZE = 64 << 10  #smaller files are not worth the trouble
+    SWEEP_INTERVAL = 3600.0
+
+    def __init__(self):
+        self.pending = set()  #cacheids being hashed
+        self.executor = None
+
+    def path(self, digest):
+        return os.path.join(self.DIR, digest[:2], digest)
+
+    def _hash(self, fd):
+        digest = hashlib.sha256()
+        while True:
+            block = os.read(fd, 1 << 20)
+            if not block:
+                return digest.hexdigest()
+            digest.update(block)
+
+    def _add(self, key, fd, stat, digest, path):
+        #(runs on the store thread) make the file that was hashed, open at fd, the stored file
+        #with digest.  It is linked by name, so must be checked to be the same inode still: a
+        #new download may have renamed another file to key since it was opened
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temppath = f'{path}{OPTS.suffix}.{os.getpid()}'
+        os.link(key, temppath)
+        try:
+            linked = os.stat(temppath)
+            if (linked.st_ino, linked.st_dev) != (stat.st_ino, stat.st_dev):
+                return  #not the file we hashed
+            try:
+                os.setxattr(fd, _XATTR, digest.encode())
+            except OSError:
+                pass  #only needed for prompt removal, see unlink()
+            os.link(temppath, path)
+        except FileExistsError:
+            pass  #stored meanwhile, by another worker process
+        finally:
+            os.remove(temppath)
+
+    def _store(self, key, mtime):
+        #(runs on the store thread) returns the bytes saved by linking key to a stored file
+        fd = os.open(key, os.O_RDONLY)
+        try:
+            stat = os.fstat(fd)
+            if 1 < stat.st_nlink or stat.st_mtime != mtime:
+                return 0  #linked already, or changed since we were asked
+            digest = self._hash(fd)
+            if os.fstat(fd).st_ctime_ns != stat.st_ctime_ns:
+                return 0  #written to while we read it
+            path = self.path(digest)
+            try:
+                stored = os.stat(path)
+            except FileNotFoundError:
+                self._add(key, fd, stat, digest, path)
+                return 0
+        finally:
+            os.close(fd)
+        if (stored.st_ino, stored.st_dev) == (stat.st_ino, stat.st_dev):
+            return 0
+        if stored.st_size != stat.st_size or stored.st_mtime != mtime:
+            return 0  #would serve this cacheid with another's Last-Modified
+        temppath = f'{key}{OPTS.suffix}.{digest[:16]}'
+        os.link(path, temppath)
+        current = os.stat(key)
+        if (current.st_ino, current.st_mtime) != (stat.st_ino, mtime):
+            os.remove(temppath)  #a new download of key has begun meanwhile
+            return 0
+        os.rename(temppath, key)
+        return stat.st_size
+
+    def schedule(self, cacheid, size, mtime):
+        #store a complete cache file in the background, or link it to an identical stored one
+        key = os.path.normpath(cacheid)
+        if not OPTS.dedup or mtime is None or size < self.MIN_SIZE or key in self.pending:
+            return
+        self.pending.add(key)
+        asyncio.ensure_future(self._run(key, mtime))
+
+    def busy(self, cacheid):
+        #whether a cache file is being hashed, so must not be written to in place
+        return os.path.normpath(cacheid) in self.pending
+
+    async def _run(self, key, mtime):
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix='replicator-dedup')
+        try:
+            saved = await asyncio.get_event_loop().run_in_executor(self.executor, self._store,
+                                                                   key, mtime)
+            if saved:
+                METRICS.dedup_bytes += saved
+                logging.info('Linked %s to an identical stored file', key)
+        except Exception as e:
+            logging.warning('Failed to store %s by content (%s)', key, e)
+        finally:
+            self.pending.discard(key)
+
+    def lookup(self, digest, size, mtime):
+        #(runs on a disk thread) path of the stored file with digest, if it has that size and mtime
+        path = self.path(digest)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        if (size is not None and stat.st_size != size) or stat.st_mtime != mtime:
+            return None
+        return path
+
+    def link(self, path, key):
+        #(runs on a disk thread) make key a link to the stored file at path
+        temppath = f'{key}{OPTS.suffix}.{os.path.basename(path)[:16]}'
+        os.link(path, temppath)
+        os.rename(temppath, key)
+
+    def unlink(self, path):
+        #(runs on a disk thread) remove a cache file, and the stored file it is linked to if that
+        #is the last link to it
+        digest = None
+        try:
+            if 2 == os.stat(path).st_nlink:
+                digest = os.getxattr(path, _XATTR).decode()
+        except OSError:
+            pass
+        os.remove(path)
+        if digest:
+            try:
+                if os.stat(self.path(digest)).st_nlink == 1:
+                    os.remove(self.path(digest))
+            except OSError:
+                pass
+
+    def _sweep(self):
+        #(runs on a disk thread) remove stored files that no cache file links to any more
+        removed = 0
+        for dirpath, dirnames, filenames in os.walk(self.DIR):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    if os.stat(path).st_nlink == 1:
+                        os.remove(path)
+                        removed += 1
+                except OSError:
+                    pass
+        return removed
+
+    async def sweep(self):
+        while True:
+            removed = await DISK.path_call(self._sweep)
+            if removed:
+                logging.info('Removed %d stored files that were no longer in use', removed)
+            await asyncio.sleep(self.SWEEP_INTERVAL)
+
+    def stop(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+
+STORE = ObjectStore()
@@ -0,0 +1,92 @@
+import asyncio, concurrent.futures, os
+from .Params import OPTS
+
+#flag for reads that are to fail, rather than block, when the data is not in the page cache
+_NOWAIT = getattr(os, 'RWF_NOWAIT', None)
+_FADVISE = hasattr(os, 'posix_fadvise')  #not on macOS
+
+
+class DiskIO:
+    #runs blocking filesystem calls on a pool of --diskthreads threads, so that a slow disk (or
+    #NFS server) stalls only the requests waiting for it, not the whole event loop.  Calls are
+    #queued per device, at most --diskqueue of them in flight on any one device.  Without the
+    #pool (--diskthreads 0), calls are made in the event loop, as they used to be.
+    PREFETCH = 1 << 20  #read-ahead unit for data that is about to be sent with sendfile()
+
+    def __init__(self):
+        self.executor = None
+        self.queues = {}  #st_dev -> semaphore
+        self.nowait = _NOWAIT is not None and hasattr(os, 'preadv')
+        self.root_dev = None  #device for operations on paths, rather than on open files
+
+    def start(self):
+        self.root_dev = os.stat('.').st_dev
+        if OPTS.diskthreads:
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=OPTS.diskthreads, thread_name_prefix='replicator-disk')
+
+    def stop(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+    async def call(self, dev, func, *args):
+        #func(*args), off the event loop; dev is the device it will (mostly) be waiting for
+        if self.executor is None:
+            return func(*args)
+        queue = self.queues.get(dev, None)
+        if queue is None:
+            queue = self.queues[dev] = asyncio.Semaphore(OPTS.diskqueue or OPTS.diskthreads)
+        async with queue:
+            return await asyncio.get_event_loop().run_in_executor(self.executor, func, *args)
+
+    async def path_call(self, func, *args):
+        return await self.call(self.root_dev, func, *args)
+
+    def _read_cached(self, fd, size, offset):
+        #data from the page cache, without blocking: None if it would have to come from disk
+        if not self.nowait or self.executor is None:
+            return None
+        buf = bytearray(size)
+        try:
+            nbytes = os.preadv(fd, [buf], offset, _NOWAIT)
+        except BlockingIOError:
+            return None
+        except OSError:  #e.g., a filesystem which does not support RWF_NOWAIT
+            self.nowait = False
+            return None
+        return memoryview(buf)[:nbytes]
+
+    async def pread(self, dev, fd, size, offset):
+        data = self._read_cached(fd, size, offset)
+        if data is None:
+            data = await self.call(dev, os.pread, fd, size, offset)
+        return data
+
+    def _prefetch(self, fd, offset, count):
+        buf = bytearray(min(count, self.PREFETCH))
+        while 0 < count:
+            nbytes = os.preadv(fd, [memoryview(buf)[:count]], offset)
+            if nbytes <= 0:
+                break
+            offset, count = offset + nbytes, count - nbytes
+
+    async def prefetch(self, dev, fd, offset, count):
+        #make sure [offset, offset+count) of the file is in the page cache, so that sendfile()
+        #will not have to wait for the disk while it holds up the event loop
+        if self.executor is None:
+            return
+        if not self.nowait:
+            #we can not tell what is cached: rather than read every window in a thread, have the
+            #kernel start reading what it does not have yet
+            if _FADVISE:
+                try:
+                    os.posix_fadvise(fd, offset, count, os.POSIX_FADV_WILLNEED)
+                except OSError:
+                    pass
+            return
+        if self._read_cached(fd, 1, offset + count - 1) is None:
+            await self.call(dev, self._prefetch, fd, offset, count)
+
+
+DISK = DiskIO()
@@ -0,0 +1,175 @@
+import asyncio, fcntl, heapq, itertools, logging, os, time
+from .Params import OPTS
+from .DiskIO import DISK
+from .HotCache import HOT
+from .Index import INDEX
+from .Dedup import STORE
+from .Journal import JOURNAL
+from .Variants import ENCODERS, VARIANTS
+
+#eviction policies: entries with the lowest score get evicted first
+POLICIES = {
+    'lru': lambda entry: entry.accessed,
+    'lfu': lambda entry: (entry.hits, entry.accessed),
+    #greedy-dual-size-frequency (with uniform cost): small, popular files are kept longest
+    'gdsf': lambda entry: entry.base + entry.hits / max(entry.size, 1),
+}
+
+
+class Evictor:
+    #keeps the cache within --maxsize bytes and --maxfiles files, by removing entries in the order
+    #given by the --evict policy; works incrementally, in the background of the event loop
+    INTERVAL = 1.0  #seconds between checks of the cache size
+    RESCAN = 10.0  #with --workers, seconds between scans for what the other workers cached
+    LOW_WATER = 0.95  #once over a limit, evict until this fraction of the limit is reached
+    BATCH = 1000  #eviction candidates chosen per pass over the index
+    SLICE = 5000  #index entries examined between yields to the event loop
+
+    def __init__(self, busy):
+        self.busy = busy  #cacheids of active downloads and readers, which are never evicted
+        self.score = POLICIES[OPTS.evict]
+        self.unlink = []  #cacheids of evicted entries, whose files are still to be removed
+
+    def _over_limit(self, fraction=1.0):
+        return ((OPTS.maxsize and OPTS.maxsize * fraction < INDEX.total_size)
+                or (OPTS.maxfiles and OPTS.maxfiles * fraction < len(INDEX.entries)))
+
+    def _busy(self):
+        return {os.path.normpath(cacheid) for cacheid in list(self.busy.keys())}
+
+    async def run(self):
+        await self._scan()
+        rescan = time.monotonic() + self.RESCAN
+        while True:
+            if 1 < OPTS.workers and rescan <= time.monotonic():
+                #only this worker evicts, and the index only tracks its own downloads
+                await self._scan(refresh=True)
+                rescan = time.monotonic() + self.RESCAN
+            if self._over_limit():
+                await self._evict()
+            await asyncio.sleep(self.INTERVAL)
+
+    def _walk(self, known):
+        #(runs on a disk thread) returns the paths of all cache files, and the stat of those which
+        #are not in known
+        files, stats = [], {}
+        skip = {OPTS.index, OPTS.index + OPTS.suffix} if OPTS.index else set()
+        for dirpath, dirnames, filenames in os.walk('.'):
+            if dirpath == '.':
+                #those come and go with the cache files they are made of, linked to, or about
+                dirnames[:] = [
+                    d for d in dirnames if d not in (VARIANTS.DIR, STORE.DIR, JOURNAL.DIR)
+                ]
+            for name in filenames:
+                path = os.path.normpath(os.path.join(dirpath, name))
+                if path in skip:
+                    continue
+                files.append(path)
+                key = path[:-len(OPTS.suffix)] if path.endswith(OPTS.suffix) else path
+                if key not in known:
+                    try:
+                        stats[path] = os.stat(path)
+                    except OSError:
+                        pass
+        return files, stats
+
+    async def _scan(self, refresh=False):
+        #learn of cache files which the index does not know about (all of them, without --index),
+        #and forget the index entries whose files have disappeared; if refresh, also update the
+        #size of those it knows, as other workers may have changed them
+        start, seen = time.time(), set()
+        files, stats = await DISK.path_call(self._walk, set() if refresh else set(INDEX.entries))
+        for i, path in enumerate(files):
+            complete = not path.endswith(OPTS.suffix)
+            key = path if complete else path[:-len(OPTS.suffix)]
+            seen.add(key)
+            stat = stats.get(path, None)
+            if stat is not None and (key not in INDEX.entries or complete
+                                     or not INDEX.entries[key].complete):
+                known = key in INDEX.entries
+                entry = INDEX.update(key, stat.st_size, stat.st_mtime if complete else None,
+                                     complete)
+                if not known:
+                    entry.accessed = stat.st_mtime  #best guess; from now on we track accesses
+            if i % self.SLICE == 0:
+                await asyncio.sleep(0)
+        for key, entry in list(INDEX.entries.items()):
+            if key not in seen and entry.accessed < start:
+                INDEX.discard(key)
+        log = logging.debug if refresh else logging.info
+        log('Cache holds %d files, %d bytes', len(INDEX.entries), INDEX.total_size)
+
+    async def _candidates(self):
+        busy, best = self._busy(), []
+        entries = list(INDEX.entries.items())
+        for i in range(0, len(entries), self.SLICE):
+            scored = ((self.score(e), k) for k, e in entries[i:i + self.SLICE] if k not in busy)
+            best = heapq.nsmallest(self.BATCH, itertools.chain(best, scored))
+            await asyncio.sleep(0)
+        return best
+
+    async def _evict(self):
+        while self._over_limit(self.LOW_WATER):
+            candidates = await self._candidates()
+            #no awaits until the victims are out of the index, so nothing can start using them
+            busy = self._busy()
+            evicted = 0
+            for score, key in candidates:
+                if not self._over_limit(self.LOW_WATER):
+                    break
+                entry = INDEX.entries.get(key, None)
+                if entry is None or key in busy or self._locked(key):
+                    continue
+                self._remove(key, entry, score)
+                evicted += 1
+            await self._unlink_pending()
+            if not evicted:
+                logging.warning('Cache is over its limits, but all of its entries are in use')
+                return
+            await asyncio.sleep(0)
+
+    def _unlink(self, keys):
+        #(runs on a disk thread)
+        for key in keys:
+            for path in [key, key + OPTS.suffix] + [VARIANTS.path(key, e) for e in ENCODERS]:
+                try:
+                    if path == key and OPTS.dedup:
+                        STORE.unlink(path)  #along with the stored file, if it was the last link
+                    else:
+                        os.remove(path)
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    logging.warning('Failed to evict %s from cache (%s)', path, e)
+
+    async def _unlink_pending(self):
+        keys, self.unlink = self.unlink, []
+        if keys:
+            await DISK.path_call(self._unlink, keys)
+
+    def _locked(self, key):
+        #with --workers, other processes' downloads are not in self.busy, but they hold a lock
+        if OPTS.workers < 2:
+            return False
+        for path in key + OPTS.suffix, key:
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except OSError:
+                continue
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return True
+            finally:
+                os.close(fd)
+        return False
+
+    def _remove(self, key, entry, score):
+        #the entry is gone from the index at once; its files get unlinked by _unlink_pending()
+        self.unlink.append(key)
+        INDEX.discard(key)
+        HOT.discard(key)
+        VARIANTS.forget(key)
+        if OPTS.evict == 'gdsf':
+            INDEX.inflation = max(INDEX.inflation, score)
+        logging.info('Evicted %s (%d bytes) from cache', key, entry.size)
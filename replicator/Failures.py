@@ -0,0 +1,104 @@
+import asyncio, logging, time
+import aiohttp
+from .Params import OPTS
+from .Metrics import METRICS
+
+#errors which mean that an upstream server is not answering at all, as opposed to answering
+#with something we do not like
+_UNREACHABLE = (aiohttp.ClientConnectionError, asyncio.TimeoutError, OSError)
+
+
+class UpstreamFailure(Exception):
+    #a request that upstream failed (or would fail) us on, with the status to tell clients
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class _Breaker:
+    __slots__ = 'failures', 'until', 'trial'
+
+    def __init__(self):
+        self.failures = 0  #consecutive requests to the server that got no answer
+        self.until = None  #while tripped, the time until which we do not ask it again
+        self.trial = False  #whether a request to find out if it is back is in progress
+
+
+class Failures:
+    #what upstream servers failed us on lately, so that clients do not all ask again: misses
+    #(403, 404 and 410, and other failures of a request) are remembered per cacheid for
+    #--negative-ttl seconds, and a server that has not answered --breaker times in a row is not
+    #asked again for a while (the breaker "trips").  After that, one request at a time finds out
+    #whether it is back.  With --workers, each process keeps its own records
+    MAX_ENTRIES = 65536  #misses remembered at most; the oldest are forgotten first
+
+    def __init__(self):
+        self.negative = {}  #cacheid -> (expiry time, status, message), oldest first
+        self.breakers = {}  #(host, port) -> _Breaker, of servers that failed lately
+
+    def lookup(self, cacheid):
+        #the (status, message) of a recent failure to fetch cacheid, or None
+        entry = self.negative.get(cacheid, None)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            del self.negative[cacheid]
+            return None
+        return entry[1:]
+
+    def remember(self, cacheid, status, message):
+        if OPTS.negative_ttl:
+            self.negative.pop(cacheid, None)  #(re)insert it as the newest
+            self.negative[cacheid] = time.monotonic() + OPTS.negative_ttl, status, message
+            while self.MAX_ENTRIES < len(self.negative):
+                del self.negative[next(iter(self.negative))]
+
+    def forget(self, cacheid):
+        self.negative.pop(cacheid, None)
+
+    def allow(self, upstream):
+        #whether to send a request to upstream (a (host, port) pair) now
+        breaker = self.breakers.get(upstream, None)
+        if breaker is None or breaker.until is None:
+            return True
+        if time.monotonic() < breaker.until or breaker.trial:
+            return False
+        breaker.trial = True  #let this one request find out whether it is back
+        return True
+
+    def retry_time(self, upstream):
+        #seconds until upstream is asked again, while its breaker is tripped
+        breaker = self.breakers.get(upstream, None)
+        return max(0.0, breaker.until - time.monotonic()) if breaker and breaker.until else 0.0
+
+    def finished(self, upstream, error=None):
+        #record how a request to upstream went: error is None if it answered, else the exception
+        if error is None or not isinstance(error, _UNREACHABLE):
+            breaker = self.breakers.get(upstream, None)
+            if isinstance(error, asyncio.CancelledError):
+                if breaker is not None:
+                    breaker.trial = False  #we will never know; let another request try
+            elif breaker is not None:
+                if breaker.until is not None:
+                    logging.info('Upstream %s:%s is answering again', *upstream)
+                del self.breakers[upstream]
+            return
+        breaker = self.breakers.setdefault(upstream, _Breaker())
+        breaker.failures += 1
+        breaker.trial = False
+        failures, seconds = OPTS.breaker
+        if failures and failures <= breaker.failures:
+            if breaker.until is None:
+                logging.warning('Upstream %s:%s failed %d times in a row; not asking it again for '
+                                '%g seconds', *upstream, breaker.failures, seconds)
+                METRICS.breaker_trips += 1
+            breaker.until = time.monotonic() + seconds
+
+    def status(self, error):
+        #the status to tell clients about a request that failed with error
+        if isinstance(error, UpstreamFailure):
+            return error.status
+        return 504 if isinstance(error, asyncio.TimeoutError) else 502
+
+
+FAILURES = Failures()
@@ -1,12 +1,71 @@
 import asyncio, calendar, logging, re, time
 from .Params import OPTS
+from .Metrics import METRICS
+
+
+class _ControlPool:
+    #logged-in FTP control connections, kept between requests so that later requests to the same
+    #server can skip connecting and logging in; connections left idle for longer than --keepalive
+    #seconds get closed
+    MAX_IDLE = 4  #idle connections kept per server
+    CHECK_AFTER = 2.0  #connections idle for longer than this get a NOOP before being re-used
+
+    def __init__(self):
+        self.idle = {}  #(host, port) -> [(reader, writer, time of release)]
+
+    def get(self, key):
+        #returns (reader, writer, seconds idle) of a pooled connection, or None
+        now = time.monotonic()
+        self._expire(now)
+        conns = self.idle.get(key, [])
+        while conns:
+            reader, writer, since = conns.pop()
+            if not reader.at_eof():  #the server did not hang up on us in the meantime
+                return reader, writer, now - since
+            writer.close()
+        return None
+
+    def put(self, key, reader, writer):
+        conns = self.idle.setdefault(key, [])
+        if len(conns) < self.MAX_IDLE:
+            conns.append((reader, writer, time.monotonic()))
+        else:
+            self._quit(writer)
+
+    def _expire(self, now):
+        for key, conns in list(self.idle.items()):
+            while conns and OPTS.keepalive < now - conns[0][2]:  #oldest are first
+                self._quit(conns.pop(0)[1])
+            if not conns:
+                del self.idle[key]
+
+    def _quit(self, writer):
+        writer.write(b'QUIT\r\n')
+        writer.close()
+
+    def close(self):
+        for conns in self.idle.values():
+            for _, writer, _ in conns:
+                self._quit(writer)
+        self.idle = {}
+
+
+POOL = _ControlPool()
+STATS = {}  #(host, port, path) -> (expiry time, mtime, size), from recent MDTM and SIZE commands
+STAT_TTL = 10.0  #seconds for which MDTM and SIZE results are re-used
+
+
+def close_pool():
+    POOL.close()
 
 
 class FtpProtocol:
     def __init__(self, request):
-        self.path, self.cacheid = request.path, request.cacheid
+        self.url, self.path, self.cacheid = request.url, request.path, request.cacheid
         self.host, self.port = request.host, request.port
         self.reader = self.writer = None
+        self.expires = None  #FTP has no notion of freshness; only --ttl applies
+        self.digest = None  #nor of content digests
 
     async def _get_result(self):
         #read a response from server, allowing for line continuations
@@ -35,8 +94,22 @@ class FtpProtocol:
         assert code == expect, f'server sends {code}; expected {expect} ({etext})'
         return message
 
-    async def fetch(self, cached_size, cached_time):
-        #connect to FTP server:
+    async def _connect(self):
+        #take a healthy connection from the pool, or else connect and log in
+        while True:
+            pooled = POOL.get((self.host, self.port))
+            if pooled is None:
+                break
+            self.reader, self.writer, idle = pooled
+            if idle < POOL.CHECK_AFTER:
+                logging.debug('Re-using FTP connection to %s port %d', self.host, self.port)
+                return
+            try:
+                await self._send_cmd('NOOP', 200, 'connection check')
+                logging.debug('Re-using FTP connection to %s port %d', self.host, self.port)
+                return
+            except (AssertionError, OSError):
+                self.writer.close()
         logging.info('Making FTP connection to %s port %d', self.host, self.port)
         self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
         await self._send_cmd(None, 220, 'service ready')
@@ -45,6 +118,21 @@ class FtpProtocol:
         await self._send_cmd(f'PASS anonymous@', 230, 'user logged in', 550)
         #request binary mode transfers:
         await self._send_cmd(f'TYPE I', 200, 'binary mode ok')
+
+    def _release(self):
+        #the control connection is idle again, so others may use it
+        POOL.put((self.host, self.port), self.reader, self.writer)
+        self.reader = self.writer = None
+
+    async def _stat(self):
+        #returns (mtime, size) of self.path, re-using the results of a recent request if we can
+        key = (self.host, self.port, self.path)
+        expiry, mtime, size = STATS.get(key, (0, None, None))
+        if time.monotonic() < expiry:
+            logging.debug('Re-using FTP server file status from a recent request')
+            return mtime, size
+        if self.writer is None:
+            await self._connect()
         #get mtime:
         message = await self._send_cmd(f'MDTM {self.path}', 213, 'file status', 550)
         try:
@@ -57,15 +145,36 @@ class FtpProtocol:
         assert message and message.isdigit(), f'File size on FTP server is unknown'
         size = int(message)
         logging.debug('FTP server file size: %d', size)
+        if 1000 < len(STATS):
+            for k in [k for k, v in STATS.items() if v[0] <= time.monotonic()]:
+                del STATS[k]
+        STATS[key] = time.monotonic() + STAT_TTL, mtime, size
+        return mtime, size
+
+    async def fetch(self, cached_size, cached_time):
+        try:
+            async for result in self._fetch(cached_size, cached_time):
+                yield result
+        finally:
+            if self.writer is not None:  #not released, so in an unknown state: do not re-use
+                self.writer.close()
+
+    async def _fetch(self, cached_size, cached_time):
+        start_time = time.monotonic()
+        mtime, size = await self._stat()
         #sanity check:
         if (cached_time is not None and cached_time < mtime) or size < cached_size:
             logging.debug('Resetting cache file for full data replacement')
             cached_size = 0
         if size == cached_size:
             #nothing to do
-            await self._send_cmd('QUIT', None, None)
+            METRICS.ttfb.observe(time.monotonic() - start_time)
+            if self.writer is not None:
+                self._release()
             yield cached_size, size, mtime, None
             return
+        if self.writer is None:
+            await self._connect()
         #open data channel:
         # [prefer EPSV (modern, IPv6 friendly), fall-back to PASV (legacy, IPv4 only)]
         code, message = await self._send_cmd(f'EPSV', None, None)
@@ -88,12 +197,11 @@ class FtpProtocol:
         if size:
             await self._send_cmd(f'REST {cached_size}', 350, 'pending further information')
         await self._send_cmd(f'RETR {self.path}', 150, 'file ok', 550)
+        METRICS.ttfb.observe(time.monotonic() - start_time)
         #transfer control back to caller:
         yield cached_size, size, mtime, data_reader
         #clean-up:
         data_writer.close()
         await data_writer.wait_closed()
         await self._send_cmd(None, 226, 'transfer complete')
-        await self._send_cmd('QUIT', None, None)
-        self.writer.close()
-        await self.writer.wait_closed()
+        self._release()
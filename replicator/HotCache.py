@@ -0,0 +1,71 @@
+import collections, os
+from aiohttp import web
+from .Params import OPTS
+from .Index import INDEX
+from .Utils import multipart_headers, resolve_ranges, response_headers
+
+
+class HotCache:
+    #memory-resident copies of small, complete cache files, so that the most requested of them
+    #can be served without opening any file, or starting a writer/reader pair.  Only files that
+    #need no word from the upstream server (fresh ones, or any with --static or --offline) are
+    #served from here.  Within --memsize bytes, the least recently used copies are dropped first.
+    #Keys are normalized, as in the index.
+    def __init__(self):
+        self.items = collections.OrderedDict()  #cacheid -> (body, mtime)
+        self.total_size = 0
+
+    def wants(self, size):
+        return 0 < OPTS.memsize and size is not None and 0 < size <= OPTS.memfile
+
+    def put(self, cacheid, body, mtime):
+        if not self.wants(len(body)):
+            return
+        key = os.path.normpath(cacheid)
+        self.discard(key)
+        self.items[key] = body, mtime
+        self.total_size += len(body)
+        while OPTS.memsize < self.total_size:
+            _, (old, _) = self.items.popitem(last=False)
+            self.total_size -= len(old)
+
+    def discard(self, cacheid):
+        item = self.items.pop(os.path.normpath(cacheid), None)
+        if item is not None:
+            self.total_size -= len(item[0])
+
+    def lookup(self, cacheid):
+        #the (body, mtime) of cacheid, if it may be served without asking the upstream server
+        key = os.path.normpath(cacheid)
+        item = self.items.get(key, None)
+        if item is None:
+            return None
+        if not (OPTS.static or OPTS.offline):
+            entry = INDEX.entries.get(key, None)
+            if entry is None or not entry.is_fresh():
+                return None
+        self.items.move_to_end(key)
+        INDEX.touch(key)
+        return item
+
+    def respond(self, item, ranges=None, encodings=None):
+        #encodings: as for Cache.reader(); None if the url does not match --compress
+        body, mtime = item
+        size = len(body)
+        response = web.Response()
+        if encodings is not None:
+            response.headers['Vary'] = 'Accept-Encoding'  #as from the cache file
+        spans = resolve_ranges(ranges, size) if ranges else [(0, size)]
+        if len(spans) == 1:
+            start, end = spans[0]
+            response_headers(response, start, end, size, mtime)
+            response.body = body if (start, end) == (0, size) else body[start:end]
+        else:
+            heads, tail = multipart_headers(response, spans, size, mtime)
+            parts = [part for head, (start, end) in zip(heads, spans)
+                     for part in (head, body[start:end])]
+            response.body = b''.join(parts) + tail
+        return response
+
+
+HOT = HotCache()
@@ -1,7 +1,32 @@
-import aiohttp, email, calendar, logging, re, time
+import aiohttp, asyncio, email, calendar, logging, re, time
 from .Params import OPTS
+from .Metrics import METRICS
+from .Bandwidth import BANDWIDTH
+from .Dedup import upstream_digest
+from .Peers import PEERS
 from .Utils import header_summary, transfer_streams
 
+SESSION = None  #process-wide upstream session; its connector pools connections per host
+
+
+async def open_session():
+    global SESSION
+    pool = {'limit': 0, 'limit_per_host': OPTS.maxconns, 'keepalive_timeout': OPTS.keepalive}
+    if OPTS.proxy_connector:
+        connector = OPTS.proxy_connector.from_url(OPTS.external, **pool)
+    else:
+        connector = aiohttp.TCPConnector(**pool)
+    #shared by all clients, so upstream cookies must not be remembered and replayed
+    SESSION = aiohttp.ClientSession(connector=connector, cookie_jar=aiohttp.DummyCookieJar(),
+                                    **OPTS.proxy)
+
+
+async def close_session():
+    global SESSION
+    if SESSION is not None:
+        await SESSION.close()
+        SESSION = None
+
 
 class HttpProtocol:
     def __init__(self, request):
@@ -9,6 +34,12 @@ class HttpProtocol:
         self.cacheid = request.cacheid
         self.headers = request.headers.copy()
         self.content = request.content
+        self.expires = None  #freshness lifetime of the response, if upstream specifies it
+        self.validator = None  #ETag or Last-Modified of the response, to pin range requests to it
+        self.digest = None  #sha256 of the body (in hex), if upstream tells us, see --dedup
+        self.siblings = PEERS.siblings(request)
+        self.peer = None  #the --peer replicator the file comes from, if any
+        self.status = None  #of the response from upstream
 
     def _parse_content_range(self, crange):
         match = re.search(r'^bytes (\d+)-(\d*)(/\d+)?$', crange)
@@ -22,44 +53,119 @@ class HttpProtocol:
         assert size is None or size == '/*' or int(size[1:]) == end
         return begin, end
 
+    def _parse_expires(self, headers):
+        #absolute expiry time from Cache-Control (preferred) or Expires; None if neither is given
+        now = time.time()
+        directives = {}
+        for item in headers.get('cache-control', '').split(','):
+            key, _, value = item.strip().partition('=')
+            directives[key.lower()] = value.strip('"')
+        if 'no-cache' in directives or 'no-store' in directives:
+            return now
+        for key in 's-maxage', 'max-age':
+            if directives.get(key, '').isdigit():
+                age = headers.get('age', '0')
+                return now + int(directives[key]) - (int(age) if age.isdigit() else 0)
+        expires = headers.get('expires', None)
+        if expires is not None:
+            expires = email.utils.parsedate(expires)
+            return calendar.timegm(expires) if expires else now  #invalid dates mean "expired"
+        return None
+
     async def fetch(self, cached_size, cached_time):
-        logging.info('Requesting GET of %s from upstream HTTP server', self.url)
         self.headers.pop('Range', None)  #we don't care about the client's requested range here
         if cached_size > 0:
             if cached_time:
                 logging.debug('Checking complete file in cache')
                 strtime = time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime(cached_time))
                 self.headers.update({'If-Range': strtime})
+            elif self.validator:  #the partial file came from this version, see Journal.py
+                self.headers.update({'If-Range': self.validator})
             self.headers.update({'Range': f'bytes={cached_size}-'})
         if OPTS.verbose > 1:
             logging.debug('%s', header_summary(self.headers, heading='GET headers:'))
         timeout = aiohttp.ClientTimeout(sock_connect=OPTS.timeout, sock_read=OPTS.timeout)
-        async with aiohttp.ClientSession(**OPTS.proxy) as session:
-            async with session.get(self.url,
-                                   timeout=timeout,
-                                   headers=self.headers,
-                                   data=self.content) as response:
-                logging.debug('Server responds %d %s', response.status, response.reason)
-                if response.status in (403, 404):
-                    yield None  #revoke cache entry
-                    return
-                if response.status in (304, 416):
-                    yield cached_size, cached_size, cached_time, None  #cache is current
-                    return
-                assert response.status in (200, 206), f'Unhandled response code: {response.status}'
-                xfer_enc = response.headers.get('transfer-encoding', 'unknown').lower()
-                logging.debug('transfer-encoding: %s', xfer_enc)
-                cache_seek, range_end = 0, response.content_length  #default to ignore cache
-                if response.status == 206:
-                    crange = response.headers.get('content-range', 'none specified')
-                    cache_seek, range_end = self._parse_content_range(crange)
-                mtime = response.headers.get('last-modified', None)
-                if mtime:
-                    mtime = calendar.timegm(email.utils.parsedate(mtime))
-                if (range_end or 0) <= cache_seek:
-                    range_end = None
-                yield cache_seek, range_end, mtime, response.content
+        if not cached_size and self.siblings:
+            self.peer = await PEERS.lookup(self.url)
+        start_time = time.monotonic()
+        response = await self._from_peer(timeout) if self.peer else None
+        if response is None:
+            logging.info('Requesting GET of %s from upstream HTTP server', self.url)
+            response = await SESSION.get(self.url, timeout=timeout, headers=self.headers,
+                                         data=self.content)
+        async with response:
+            METRICS.ttfb.observe(time.monotonic() - start_time)
+            logging.debug('Server responds %d %s', response.status, response.reason)
+            self.status = response.status
+            self.expires = self._parse_expires(response.headers)
+            self.digest = upstream_digest(response.headers)
+            if response.status in (403, 404, 410):
+                yield None  #revoke cache entry
+                return
+            if response.status in (304, 416):
+                yield cached_size, cached_size, cached_time, None  #cache is current
+                return
+            assert response.status in (200, 206), f'Unhandled response code: {response.status}'
+            self.validator = None
+            if self._accepts_ranges(response):
+                etag = response.headers.get('etag', '')
+                self.validator = response.headers.get('last-modified', None)
+                if etag.startswith('"'):  #weak etags are not allowed in If-Range
+                    self.validator = etag
+            xfer_enc = response.headers.get('transfer-encoding', 'unknown').lower()
+            logging.debug('transfer-encoding: %s', xfer_enc)
+            cache_seek, range_end = 0, response.content_length  #default to ignore cache
+            if response.status == 206:
+                crange = response.headers.get('content-range', 'none specified')
+                cache_seek, range_end = self._parse_content_range(crange)
+            mtime = response.headers.get('last-modified', None)
+            if mtime:
+                mtime = calendar.timegm(email.utils.parsedate(mtime))
+            if (range_end or 0) <= cache_seek:
+                range_end = None
+            yield cache_seek, range_end, mtime, response.content
+            return
+
+    async def _from_peer(self, timeout):
+        #the response of the peer that has the file, or None if it fails us after all
+        try:
+            response = await PEERS.get(self.url, self.peer, self.headers, timeout)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.warning('Failed to fetch %s from peer %s (%s)', self.url, self.peer, e)
+            response = None
+        if response is not None and response.status != 200:
+            logging.debug('Peer %s responds %d %s', self.peer, response.status, response.reason)
+            response.release()
+            response = None
+        if response is None:
+            self.peer = None
+            return None
+        logging.info('Fetching %s from peer %s', self.url, self.peer)
+        METRICS.peer_hits += 1
+        return response
+
+    def _accepts_ranges(self, response):
+        #ranges of content-encoded bodies would not line up with what we store
+        return ((response.status == 206
+                 or response.headers.get('accept-ranges', '').lower() == 'bytes')
+                and 'content-encoding' not in response.headers)
+
+    async def fetch_range(self, start, end):
+        #fetch [start, end) of the very file that fetch() is receiving, as one more part of a
+        #segmented download; yields its data stream, or None if the server does not cooperate
+        assert self.validator, 'fetch_range() needs a response validator from fetch()'
+        logging.debug('Requesting bytes %d-%d of %s from upstream', start, end - 1, self.url)
+        headers = self.headers.copy()
+        headers.update({'Range': f'bytes={start}-{end - 1}', 'If-Range': self.validator})
+        timeout = aiohttp.ClientTimeout(sock_connect=OPTS.timeout, sock_read=OPTS.timeout)
+        async with SESSION.get(self.url, timeout=timeout, headers=headers) as response:
+            crange = response.headers.get('content-range', 'none specified')
+            if response.status != 206 or not crange.startswith(f'bytes {start}-{end - 1}/'):
+                logging.debug('Server responds %d %s to range request', response.status,
+                              response.reason)
+                yield None  #e.g., the file changed since fetch() started
                 return
+            yield response.content
 
 
 # we do not cache non-GET requests; pass request through verbatim
@@ -68,14 +174,13 @@ async def blind_transfer(request, output, downstream):
     logging.info('Making blind %s request for %s', request.method, request.url)
     assert not OPTS.offline, f'Blind transfers are incompatible with "offline" mode'
     timeout = aiohttp.ClientTimeout(sock_connect=OPTS.timeout, sock_read=OPTS.timeout)
-    async with aiohttp.ClientSession(**OPTS.proxy) as session:
-        async with session.request(request.method,
-                                   request.url,
-                                   timeout=timeout,
-                                   headers=request.headers,
-                                   data=downstream.content) as upresp:
-            logging.debug('Upstream server responded %s - %s', upresp.status, upresp.reason)
-            output.set_status(upresp.status, upresp.reason)
-            output.headers.update(upresp.headers)
-            await output.prepare(downstream)
-            await transfer_streams(upresp.content, output)
+    async with SESSION.request(request.method, request.url, timeout=timeout,
+                               headers=request.headers, data=downstream.content) as upresp:
+        logging.debug('Upstream server responded %s - %s', upresp.status, upresp.reason)
+        output.set_status(upresp.status, upresp.reason)
+        output.headers.update(upresp.headers)
+        await output.prepare(downstream)
+        nbytes = await transfer_streams(upresp.content, output, 'Blind transfer',
+                                        bucket=BANDWIDTH.downstream(downstream.remote))
+        METRICS.upstream_bytes += nbytes
+        METRICS.downstream_bytes += nbytes
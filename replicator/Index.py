@@ -0,0 +1,101 @@
+import json, logging, os, time
+from .Params import OPTS
+
+
+class IndexEntry:
+    __slots__ = 'size', 'mtime', 'complete', 'validated', 'expires', 'accessed', 'hits', 'base'
+
+    def __init__(self, size, mtime, complete, validated=None, expires=None, accessed=None, hits=0,
+                 base=0.0):
+        self.size = size
+        self.mtime = mtime
+        self.complete = complete
+        self.validated = validated  #time of last confirmation by the upstream server
+        self.expires = expires  #until this time, the file may be served without revalidation
+        self.accessed = time.time() if accessed is None else accessed  #time of last request
+        self.hits = hits  #number of requests
+        self.base = base  #eviction "inflation" level at time of last request (for GDSF)
+
+    def is_fresh(self):
+        return self.complete and self.expires is not None and time.time() < self.expires
+
+
+class Index:
+    #memory-resident record of what the cache directory holds, keyed by cacheid; it lets most
+    #requests open the right file directly, rather than probing the filesystem for it.  Entries
+    #are only hints: whoever opens a file still checks that it is really there.
+    #Keys are normalized, so that a cacheid and its path as found on disk refer to the same entry.
+    def __init__(self):
+        self.entries = {}
+        self.dirs = set()  #directories known to exist, so we need not makedirs() them again
+        self.total_size = 0  #bytes used by all entries, complete or not
+        self.inflation = 0.0  #raised by GDSF eviction, so that old popularity fades over time
+
+    def get(self, cacheid):
+        return self.entries.get(os.path.normpath(cacheid), None)
+
+    def update(self, cacheid, size, mtime, complete, validated=False, expires=None):
+        key = os.path.normpath(cacheid)
+        entry = self.entries.get(key, None)
+        if entry is None:
+            entry = self.entries[key] = IndexEntry(0, mtime, complete)
+        self.total_size += size - entry.size
+        entry.size, entry.mtime, entry.complete = size, mtime, complete
+        if validated:
+            entry.validated, entry.expires = time.time(), expires
+        return entry
+
+    def resize(self, cacheid, size):
+        #cheap update of an entry's size, for downloads in progress
+        entry = self.entries.get(os.path.normpath(cacheid), None)
+        if entry is not None:
+            self.total_size += size - entry.size
+            entry.size = size
+
+    def touch(self, cacheid):
+        entry = self.entries.get(os.path.normpath(cacheid), None)
+        if entry is not None:
+            entry.accessed = time.time()
+            entry.hits += 1
+            entry.base = self.inflation
+
+    def discard(self, cacheid):
+        entry = self.entries.pop(os.path.normpath(cacheid), None)
+        if entry is not None:
+            self.total_size -= entry.size
+
+    def makedirs(self, dir_path, force=False):
+        if dir_path and (force or dir_path not in self.dirs):
+            os.makedirs(dir_path, exist_ok=True)
+            self.dirs.add(dir_path)
+
+    def load(self, path):
+        try:
+            with open(path) as f:
+                snapshot = json.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logging.warning('Ignoring unreadable index snapshot %s (%s)', path, e)
+            return
+        for cacheid, fields in snapshot.get('entries', {}).items():
+            entry = self.entries[os.path.normpath(cacheid)] = IndexEntry(*fields)
+            self.total_size += entry.size
+        self.inflation = snapshot.get('inflation', 0.0)
+        logging.info('Loaded %d cache index entries from %s', len(self.entries), path)
+
+    def save(self, path):
+        entries = {
+            cacheid: [
+                e.size, e.mtime, e.complete, e.validated, e.expires, e.accessed, e.hits, e.base
+            ]
+            for cacheid, e in self.entries.items()
+        }
+        temppath = path + OPTS.suffix
+        with open(temppath, 'w') as f:
+            json.dump({'version': 1, 'inflation': self.inflation, 'entries': entries}, f)
+        os.rename(temppath, path)  #never leave a half-written snapshot behind
+        logging.info('Saved %d cache index entries to %s', len(entries), path)
+
+
+INDEX = Index()
@@ -0,0 +1,111 @@
+import asyncio, hashlib, json, logging, os
+from yarl import URL
+from .Params import OPTS
+from .DiskIO import DISK
+
+
+class Journal:
+    #a record of the large downloads in progress, so that they can be resumed after a crash or
+    #restart without a client asking for them again: one small file per download below DIR, with
+    #the url, the validator to resume it with, and how much of the cache file is known to be on
+    #disk for good (it is synced before this count goes up).  Entries are written by whichever
+    #process fetches the file, and removed once it is complete.
+    DIR = '.journal'
+    CHECKPOINT = 16 << 20  #bytes to download between updates of an entry
+
+    def path(self, cacheid):
+        return os.path.join(self.DIR, hashlib.sha1(cacheid.encode()).hexdigest())
+
+    def _write(self, cacheid, entry):
+        #(runs on a disk thread)
+        path = self.path(cacheid)
+        os.makedirs(self.DIR, exist_ok=True)
+        with open(path + OPTS.suffix, 'w') as f:
+            json.dump(entry, f)
+            f.flush()
+            os.fdatasync(f.fileno())
+        os.replace(path + OPTS.suffix, path)
+
+    def read(self, cacheid):
+        #(runs on a disk thread) the entry of cacheid, or None
+        try:
+            with open(self.path(cacheid)) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return entry if entry.get('cacheid', None) == cacheid else None
+
+    async def begin(self, cacheid, proto, size, confirmed):
+        #record a download that is starting; proto is the HttpProtocol or FtpProtocol fetching it
+        entry = {
+            'cacheid': cacheid,
+            'url': str(proto.url),
+            'protocol': proto.url.scheme,
+            'name': proto.headers.get('x-unique-cache-name', None),
+            'validator': getattr(proto, 'validator', None),
+            'size': size,
+            'confirmed': confirmed,
+        }
+        await DISK.path_call(self._write, cacheid, entry)
+        return entry
+
+    async def confirm(self, entry, confirmed):
+        entry['confirmed'] = confirmed
+        await DISK.path_call(self._write, entry['cacheid'], entry)
+
+    def _remove(self, cacheid):
+        #(runs on a disk thread)
+        try:
+            os.remove(self.path(cacheid))
+        except FileNotFoundError:
+            pass
+
+    async def end(self, cacheid):
+        await DISK.path_call(self._remove, cacheid)
+
+    def load(self):
+        #(at startup) the entries of downloads that were cut short, with their cache files cut
+        #back to what is known to be intact; entries of files that are gone are dropped.  With
+        #--workers, this runs before they are forked: nothing else may write the files yet
+        entries = []
+        try:
+            names = os.listdir(self.DIR)
+        except FileNotFoundError:
+            return entries
+        for name in names:
+            path = os.path.join(self.DIR, name)
+            try:
+                with open(path) as f:
+                    entry = json.load(f)
+                temppath = entry['cacheid'] + OPTS.suffix
+                if entry['confirmed'] < os.stat(temppath).st_size:
+                    os.truncate(temppath, entry['confirmed'])
+                entries.append(entry)
+            except (OSError, ValueError, KeyError):
+                logging.debug('Dropping journal entry %s', name)
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        return entries
+
+    async def resume(self, fetch, entries):
+        #fetch(url, headers) the rest of the downloads of entries, up to --resume at a time
+        queue = asyncio.Semaphore(OPTS.resume)
+
+        async def resume_one(entry):
+            async with queue:
+                logging.info('Resuming download of %s from byte %d', entry['url'],
+                             entry['confirmed'])
+                headers = {'x-unique-cache-name': entry['name']} if entry['name'] else {}
+                try:
+                    await fetch(URL(entry['url']), headers)
+                except Exception as e:
+                    logging.warning('Failed to resume download of %s (%s)', entry['url'], e)
+
+        if entries:
+            logging.info('Resuming %d interrupted downloads', len(entries))
+            await asyncio.gather(*(resume_one(entry) for entry in entries))
+
+
+JOURNAL = Journal()
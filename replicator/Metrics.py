@@ -0,0 +1,107 @@
+import bisect
+
+#upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Histogram:
+    __slots__ = 'name', 'bounds', 'counts', 'sum'
+
+    def __init__(self, name, bounds=LATENCY_BUCKETS):
+        self.name = name
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  #the last bucket is +Inf
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def render(self, lines):
+        total = 0
+        for bound, count in zip(self.bounds + ('+Inf', ), self.counts):
+            total += count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {total}')
+        lines.append(f'{self.name}_sum {self.sum}')
+        lines.append(f'{self.name}_count {total}')
+
+
+class Metrics:
+    #process-wide counters and histograms, rendered in the Prometheus text format on request.
+    #Updating them is no more than an attribute increment (or a bisect, for histograms), so
+    #instrumentation stays on all the time
+    COUNTERS = (
+        #(attribute, metric name, labels)
+        ('hits', 'replicator_lookups_total', 'outcome="hit"'),
+        ('misses', 'replicator_lookups_total', 'outcome="miss"'),
+        ('revalidations', 'replicator_lookups_total', 'outcome="revalidated"'),
+        ('revocations', 'replicator_lookups_total', 'outcome="revoked"'),
+        ('merges', 'replicator_lookups_total', 'outcome="merged"'),
+        ('memory_hits', 'replicator_lookups_total', 'outcome="memory"'),
+        ('negative_hits', 'replicator_lookups_total', 'outcome="negative"'),
+        ('stale', 'replicator_lookups_total', 'outcome="stale"'),
+        ('blind', 'replicator_blind_requests_total', ''),
+        ('errors', 'replicator_errors_total', ''),
+        ('upstream_bytes', 'replicator_upstream_bytes_total', ''),
+        ('downstream_bytes', 'replicator_downstream_bytes_total', ''),
+        ('dedup_bytes', 'replicator_dedup_bytes_total', ''),
+        ('demand_fetches', 'replicator_demand_fetches_total', ''),
+        ('throttled_seconds', 'replicator_throttled_seconds_total', ''),
+        ('peer_hits', 'replicator_peer_requests_total', 'outcome="fetched"'),
+        ('peer_forwards', 'replicator_peer_requests_total', 'outcome="forwarded"'),
+        ('breaker_trips', 'replicator_breaker_trips_total', ''),
+    )
+    HELP = {
+        'replicator_lookups_total': 'GET requests, by how the cache dealt with them',
+        'replicator_blind_requests_total': 'requests passed through without caching',
+        'replicator_errors_total': 'requests that failed with an error',
+        'replicator_upstream_bytes_total': 'bytes received from upstream servers',
+        'replicator_downstream_bytes_total': 'bytes of response bodies sent to clients',
+        'replicator_dedup_bytes_total':
+            'bytes of cache files linked to identical ones, see --dedup',
+        'replicator_demand_fetches_total': 'range fetches for clients far ahead of a download',
+        'replicator_throttled_seconds_total': 'time transfers waited for --limit/--client-limit',
+        'replicator_peer_requests_total': 'files fetched from, or requests forwarded to, peers',
+        'replicator_breaker_trips_total': 'upstream servers given up on for a while, see --breaker',
+        'replicator_upstream_ttfb_seconds': 'time from upstream request to response headers',
+        'replicator_cache_open_seconds': 'time to find and open a file in the cache',
+        'replicator_request_seconds': 'time to serve a request, from start to finish',
+        'replicator_active_downloads': 'cache entries being fetched from upstream',
+        'replicator_active_readers': 'clients being served from the cache',
+        'replicator_cache_readers': 'clients being served, per cache entry being fetched',
+        'replicator_memory_bytes': 'bytes of files kept in memory (see --memsize)',
+    }
+
+    def __init__(self):
+        for attr, _, _ in self.COUNTERS:
+            setattr(self, attr, 0)
+        self.ttfb = Histogram('replicator_upstream_ttfb_seconds')
+        self.open_time = Histogram('replicator_cache_open_seconds')
+        self.request_time = Histogram('replicator_request_seconds')
+        self.gauges = []  #functions returning [(metric name, labels, value)], called on render
+
+    def _heading(self, lines, name, kind):
+        lines.append(f'# HELP {name} {self.HELP[name]}')
+        lines.append(f'# TYPE {name} {kind}')
+
+    def render(self):
+        lines, seen = [], set()
+        for attr, name, labels in self.COUNTERS:
+            if name not in seen:
+                seen.add(name)
+                self._heading(lines, name, 'counter')
+            lines.append(f'{name}{{{labels}}} {getattr(self, attr)}' if labels else
+                         f'{name} {getattr(self, attr)}')
+        for histogram in self.ttfb, self.open_time, self.request_time:
+            self._heading(lines, histogram.name, 'histogram')
+            histogram.render(lines)
+        for gauge in self.gauges:
+            for name, labels, value in gauge():
+                if name not in seen:
+                    seen.add(name)
+                    self._heading(lines, name, 'gauge')
+                lines.append(f'{name}{{{labels}}} {value}' if labels else f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = Metrics()
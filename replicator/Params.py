@@ -1,5 +1,6 @@
 import argparse, logging, os, sys
 from ipaddress import ip_network
+from .Routing import CidrTable, PrefixTable
 
 
 def parse_args():
@@ -15,6 +16,45 @@ def parse_args():
             raise argparse.ArgumentTypeError('value must be a positive number')
         return x
 
+    def byte_size(s):
+        units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+        try:
+            if s[-1:].upper() in units:
+                return int(float(s[:-1]) * units[s[-1].upper()])
+            return int(s)
+        except ValueError:
+            raise argparse.ArgumentTypeError('SIZE must be a number of bytes, optionally '
+                                             'followed by one of K, M, G or T')
+
+    def client_limit(s):
+        cidr, _, rate = s.rpartition('=')
+        try:
+            return ip_network(cidr), positive_number(rate) * 1024
+        except ValueError:
+            raise argparse.ArgumentTypeError('client limit must be CIDR=RATE')
+
+    def peer_url(s):
+        if not s.startswith('http://') or len(s) <= len('http://'):
+            raise argparse.ArgumentTypeError('peer must be given as http://HOST:PORT')
+        return s.rstrip('/')
+
+    def breaker(s):
+        failures, _, seconds = s.partition(':')
+        try:
+            failures = int(failures)
+            if failures < 0:
+                raise ValueError()
+            return failures, positive_number(seconds or '30')
+        except ValueError:
+            raise argparse.ArgumentTypeError('breaker must be N or N:SECONDS')
+
+    def ttl_mapping(s):
+        seconds, _, pattern = s.partition(':')
+        try:
+            return pattern or '*', positive_number(seconds)
+        except ValueError:
+            raise argparse.ArgumentTypeError('TTL must be SECONDS or SECONDS:URLPATTERN')
+
     parser = argparse.ArgumentParser(description='http-replicator: a caching http proxy',
                                      add_help=False)
     # yapf: disable
@@ -28,9 +68,26 @@ def parse_args():
     parser.add_argument(
         '--root', '-r', '-d', '--dir', metavar='ROOTDIR',
         help='set cache base directory to ROOTDIR (default is the current directory)')
+    parser.add_argument(
+        '--workers', '-w', default=1, type=int, metavar='N',
+        help='serve requests with N worker processes (default=1)')
+    parser.add_argument(
+        '--metrics', metavar='PORT', type=port_number,
+        help='serve metrics, in the Prometheus text format, and accept cache warming jobs on '
+             'PORT (with --workers, each worker serves its own on the next port up)')
     parser.add_argument(
         '--external', '-e', default=os.environ.get('http_proxy', None), metavar='PROXYURL',
         help='forward requests through external proxy server')
+    parser.add_argument(
+        '--peer', default=[], metavar='URL', type=peer_url, action='append',
+        help='share files with the replicator at URL (http://HOST:PORT): on a miss, ask it '
+             'whether it has the file, and fetch it from there if so; option may be repeated '
+             '(the first peer to answer is used)')
+    parser.add_argument(
+        '--peer-hash', metavar='URL', type=peer_url,
+        help='instead, assign each file to one of the --peer replicators and this one (known to '
+             'them as URL) by consistent hashing, and forward requests for files that are not '
+             'ours to their owner')
     parser.add_argument(
         '--ip', '-i', default=[], metavar='CIDR', action='append',
         help='restrict incoming requests to be from specified CIDR '
@@ -46,6 +103,30 @@ def parse_args():
     parser.add_argument(
         '--timeout', '-t', default=15, type=positive_number,
         help='break connection after TIMEOUT seconds of inactivity (default=15)')
+    parser.add_argument(
+        '--warmconns', default=2, type=int, metavar='N',
+        help='when warming the cache, fetch at most N files at a time from each upstream host '
+             '(default=2)')
+    parser.add_argument(
+        '--resume', default=2, type=int, metavar='N',
+        help='at startup, resume large downloads that were cut short by a crash or restart, N '
+             'at a time (default=2; 0 leaves them until a client asks for them again)')
+    parser.add_argument(
+        '--maxconns', default=0, type=int, metavar='N',
+        help='allow at most N simultaneous connections to each upstream host '
+             '(default=0, meaning no limit)')
+    parser.add_argument(
+        '--keepalive', default=15, type=positive_number, metavar='SEC',
+        help='keep idle upstream connections open for re-use for SEC seconds (default=15)')
+    parser.add_argument(
+        '--segments', default=1, type=int, metavar='K',
+        help='download large files from HTTP servers which accept range requests as K parts '
+             'in parallel (default=1, meaning a single stream)')
+    parser.add_argument(
+        '--segment-size', default='16M', type=byte_size, metavar='SIZE',
+        help='with --segments, make no part of a download smaller than SIZE bytes; also, fetch '
+             'the file by range for clients waiting more than SIZE bytes ahead of its download; '
+             'SIZE may have a suffix of K, M, G or T (default=16M)')
     parser.add_argument(
         '--verbose', '-v', default=0, action='count',
         help='show transaction activity; use twice for debugging')
@@ -55,12 +136,83 @@ def parse_args():
     parser.add_argument(
         '--static', '-s', action='store_true',
         help='static mode: assume files never change')
+    parser.add_argument(
+        '--ttl', default=[], metavar='SECONDS[:URLPATTERN]', type=ttl_mapping, action='append',
+        help='unless the upstream server says otherwise (with Cache-Control or Expires), '
+             'serve cached files matching the shell-style URLPATTERN (default *) for SECONDS '
+             'after their last validation, without checking with the upstream server again; '
+             'option may be repeated (first matching URLPATTERN, in command-line order, wins)')
+    parser.add_argument(
+        '--negative-ttl', default=10, type=float, metavar='SECONDS',
+        help='answer requests for files which upstream did not have, or failed to send, with the '
+             'same error for SECONDS, without asking it again (default=10; 0 disables this)')
+    parser.add_argument(
+        '--breaker', default=(5, 30.0), type=breaker, metavar='N[:SECONDS]',
+        help='once an upstream server has failed to answer N requests in a row, fail requests '
+             'for it (or serve cached files without revalidation) for SECONDS (default 30), then '
+             'try it again; default=5, 0 disables this')
     parser.add_argument(
         '--offline', action='store_true',
         help='offline mode: never initiate a network connection')
     parser.add_argument(
-        '--limit', default=0, type=float,
-        help='cap download rate to LIMIT KiB/s')
+        '--limit', default=0, type=float, metavar='RATE',
+        help='cap the total rate of downloads from upstream servers to RATE KiB/s')
+    parser.add_argument(
+        '--client-limit', default=[], type=client_limit, metavar='CIDR=RATE', action='append',
+        help='cap the total rate of data sent to clients within CIDR to RATE KiB/s; option may '
+             'be repeated (first matching CIDR, in command-line order, wins)')
+    parser.add_argument(
+        '--burst', default=1.0, type=positive_number, metavar='SECONDS',
+        help='let rates capped by --limit and --client-limit exceed their cap after a quiet '
+             'spell, by as much as SECONDS worth of it (default=1)')
+    parser.add_argument(
+        '--maxsize', default=0, type=byte_size, metavar='SIZE',
+        help='evict files from the cache to keep it under SIZE bytes; SIZE may have a suffix of '
+             'K, M, G or T (default=0, meaning no limit)')
+    parser.add_argument(
+        '--maxfiles', default=0, type=int, metavar='N',
+        help='evict files from the cache to keep it under N files (default=0, meaning no limit)')
+    parser.add_argument(
+        '--evict', default='lru', choices=('lru', 'lfu', 'gdsf'),
+        help='order in which files are evicted: least recently used, least frequently used, or '
+             'greedy-dual-size-frequency, which favors keeping small popular files (default=lru)')
+    parser.add_argument(
+        '--index', metavar='FILE',
+        help='load the cache index from FILE at startup, and save it there at shutdown')
+    parser.add_argument(
+        '--compress', default=[], metavar='URLPATTERN', action='append',
+        help='keep gzip (and, with the zstandard module, zstd) compressed copies of cached files '
+             'matching the shell-style URLPATTERN, for clients which accept them; option may be '
+             'repeated')
+    parser.add_argument(
+        '--dedup', action='store_true',
+        help='store complete files of the same content (and mtime) only once, as hardlinks to a '
+             'file named after their sha256 digest; a download whose digest upstream gives is '
+             'skipped if that file is stored already')
+    parser.add_argument(
+        '--memsize', default='32M', type=byte_size, metavar='SIZE',
+        help='keep up to SIZE bytes of small, frequently requested files in memory, to serve '
+             'them from there while they need no revalidation (default=32M; 0 disables this)')
+    parser.add_argument(
+        '--memfile', default='256K', type=byte_size, metavar='SIZE',
+        help='largest file to keep in memory, see --memsize (default=256K)')
+    parser.add_argument(
+        '--minchunk', default=8, type=positive_number, metavar='KIB',
+        help='smallest buffer size, in KiB, used for slow transfers (default=8)')
+    parser.add_argument(
+        '--maxchunk', default=1024, type=positive_number, metavar='KIB',
+        help='largest buffer size, in KiB, that fast transfers may grow to (default=1024)')
+    parser.add_argument(
+        '--no-sendfile', dest='sendfile', action='store_false',
+        help='always copy cached data through userspace, rather than using sendfile()')
+    parser.add_argument(
+        '--diskthreads', default=8, type=int, metavar='N',
+        help='do blocking disk I/O on a pool of N threads, rather than in the event loop '
+             '(default=8; 0 means no threads)')
+    parser.add_argument(
+        '--diskqueue', default=4, type=int, metavar='N',
+        help='with --diskthreads, allow at most N disk operations in progress on any one '
+             'device (default=4)')
     parser.add_argument(
         '--daemon', metavar='LOGFILE',
         help='route output to specified LOGFILE, and detach')
@@ -76,26 +228,54 @@ def parse_args():
     OPTS = parser.parse_args()
     if not OPTS.bind:
         OPTS.bind = ['::1']
-    OPTS.allowed_CIDRs = []
-    for cidr in OPTS.ip:
-        OPTS.allowed_CIDRs.append(ip_network(cidr))
+    if OPTS.workers < 1:
+        parser.error('--workers must be at least 1')
+    if OPTS.metrics is not None and not 1 <= OPTS.metrics <= 65536 - OPTS.workers:
+        #worker i serves metrics on PORT+i
+        parser.error(f'--metrics PORT must be in interval [1, {65536 - OPTS.workers}] with '
+                     f'{OPTS.workers} workers')
+    if OPTS.segments < 1:
+        parser.error('--segments must be at least 1')
+    if OPTS.segment_size < 1:
+        parser.error('--segment-size must be at least 1')
+    if OPTS.maxsize < 0 or OPTS.maxfiles < 0:
+        parser.error('--maxsize and --maxfiles can not be negative')
+    if OPTS.memsize < 0 or OPTS.memfile < 0:
+        parser.error('--memsize and --memfile can not be negative')
+    if OPTS.resume < 0:
+        parser.error('--resume can not be negative')
+    if OPTS.peer_hash and not OPTS.peer:
+        parser.error('--peer-hash needs --peer')
+    OPTS.peer = [peer for peer in dict.fromkeys(OPTS.peer) if peer != OPTS.peer_hash]
+    if OPTS.negative_ttl < 0:
+        parser.error('--negative-ttl can not be negative')
+    if OPTS.warmconns < 1:
+        parser.error('--warmconns must be at least 1')
+    if OPTS.diskthreads < 0 or OPTS.diskqueue < 0:
+        parser.error('--diskthreads and --diskqueue can not be negative')
+    OPTS.worker = 0  #which of the --workers processes we are
+    OPTS.allowed_CIDRs = CidrTable((cidr, True) for cidr in OPTS.ip)
     OPTS.aliasmap = []
     for alias in OPTS.alias:
         maplist = alias.split(':')
         destdir = maplist.pop(0)
         for prefix in maplist:
             OPTS.aliasmap.append((prefix, destdir))
+    OPTS.aliases = PrefixTable(OPTS.aliasmap)
     OPTS.limit *= 1024
-    OPTS.maxchunk = 8192
+    OPTS.minchunk = int(OPTS.minchunk * 1024)
+    OPTS.maxchunk = max(int(OPTS.maxchunk * 1024), OPTS.minchunk)
+    OPTS.flushsize = 65536  #batch cache writes (and reader wake-ups) to at least this many bytes
+    OPTS.flushtime = 0.1  #...unless data sits unwritten for this many seconds
     OPTS.suffix = '.incomplete'
     OPTS.maxfilelen = os.pathconf('.', 'PC_NAME_MAX') - len(OPTS.suffix)
     OPTS.version = 'replicator/4.0alpha4'
-    OPTS.proxy = {}
+    OPTS.proxy, OPTS.proxy_connector = {}, None
     if OPTS.external:
         try:
             from aiohttp_socks import ProxyConnector
             #user is running with aiohttp_socks (>= 0.3.1) installed:
-            OPTS.proxy = {'connector': ProxyConnector.from_url(OPTS.external)}
+            OPTS.proxy_connector = ProxyConnector
         except:
             #make an attempt to use aiohttp's built-in proxy handling
             assert OPTS.external.startswith(
@@ -109,7 +289,8 @@ def setup_logging():
     global OPTS
     OPTS._logstream = open(OPTS.daemon, 'a') if OPTS.daemon else sys.stdout
     loglevel = (logging.WARNING, logging.INFO, logging.DEBUG)[min(OPTS.verbose, 2)]
-    logging.basicConfig(stream=OPTS._logstream, level=loglevel, format='%(message)s')
+    logformat = '[%(process)d] %(message)s' if 1 < OPTS.workers else '%(message)s'
+    logging.basicConfig(stream=OPTS._logstream, level=loglevel, format=logformat)
 
 
 #initialize:
@@ -0,0 +1,126 @@
+import asyncio, email.utils, logging, os
+import aiohttp
+from aiohttp import web
+from .Params import OPTS
+from .Bandwidth import BANDWIDTH
+from .DiskIO import DISK
+from .Index import INDEX
+from .Metrics import METRICS
+from .Routing import HashRing
+from .Utils import transfer_streams
+
+#requests from one replicator to another carry this header; they are answered from the cache of
+#the replicator they are sent to (or from upstream), never passed on to a third one
+HOP_HEADER = 'X-Replicator-Peer'
+
+
+class Peers:
+    #the other replicators of a cluster (--peer), which we use as proxies: either as siblings,
+    #which are asked on a miss whether they have the file, and it is fetched from the first that
+    #does; or, with --peer-hash, as owners of the files that consistent hashing of their cacheids
+    #assigns to them, to which requests for those files are forwarded, so that each file is
+    #fetched and stored by one replicator only.  Peers are reached directly, not via --external
+    LOOKUP_TIMEOUT = 1.0  #seconds to wait for peers to answer a lookup
+
+    def __init__(self):
+        self.peers = OPTS.peer
+        self.ring = HashRing(self.peers + [OPTS.peer_hash]) if OPTS.peer_hash else None
+        self.session = None
+
+    async def open(self):
+        if self.peers:
+            connector = aiohttp.TCPConnector(limit=0, keepalive_timeout=OPTS.keepalive)
+            #bodies are passed on as they come: they may be compressed variants, see --compress
+            self.session = aiohttp.ClientSession(connector=connector, auto_decompress=False,
+                                                 cookie_jar=aiohttp.DummyCookieJar())
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def siblings(self, inquest):
+        #whether to ask the peers for the file of a cache miss (of an http url)
+        return bool(self.peers) and self.ring is None and not inquest.from_peer
+
+    def owner(self, inquest):
+        #the peer to forward a request to, or None if we are to serve it ourselves
+        if self.ring is None or inquest.from_peer or OPTS.offline:
+            return None
+        if inquest.method != 'GET' or inquest.url.scheme != 'http':
+            return None
+        owner = self.ring.owner(inquest.cacheid)
+        return None if owner == OPTS.peer_hash else owner
+
+    async def lookup(self, url):
+        #the first of the peers to say that it has the complete file of url, or None if none
+        #does, within LOOKUP_TIMEOUT
+        headers = {HOP_HEADER: '1', 'Cache-Control': 'only-if-cached'}
+        timeout = aiohttp.ClientTimeout(total=self.LOOKUP_TIMEOUT)
+
+        async def ask(peer):
+            try:
+                async with self.session.head(url, proxy=peer, headers=headers,
+                                             timeout=timeout) as response:
+                    return peer if response.status == 200 else None
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logging.debug('Peer %s failed to answer lookup (%s)', peer, e)
+                return None
+
+        tasks = [asyncio.ensure_future(ask(peer)) for peer in self.peers]
+        try:
+            for fut in asyncio.as_completed(tasks):
+                peer = await fut
+                if peer is not None:
+                    logging.debug('Peer %s has %s', peer, url)
+                    return peer
+            return None
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def answer(self, cacheid):
+        #our response to a peer's lookup: 200 if we have the complete file of cacheid, else 504
+        #(as for any request with Cache-Control: only-if-cached that a cache can not satisfy)
+        headers = {'Server': OPTS.version}
+        entry = INDEX.get(cacheid)
+        if entry is None or entry.complete:
+            try:
+                stat = await DISK.path_call(os.stat, cacheid)
+                headers['Last-Modified'] = email.utils.formatdate(stat.st_mtime, usegmt=True)
+                return web.Response(status=200, headers=headers)
+            except OSError:
+                pass
+        return web.Response(status=504, headers=headers)
+
+    def get(self, url, peer, headers, timeout):
+        #a GET of url from peer, as a request made with the session would be
+        headers = headers.copy()
+        headers.update({HOP_HEADER: '1', 'Accept-Encoding': 'identity'})
+        return self.session.get(url, proxy=peer, headers=headers, timeout=timeout)
+
+    async def forward(self, inquest, output, downstream, peer):
+        #pass a request on to the peer that owns its file, and the response back; returns False
+        #(having sent nothing) if the peer can not be reached, so that we serve it ourselves
+        logging.info('Forwarding request for %s to peer %s', inquest.url, peer)
+        headers = inquest.headers.copy()
+        headers[HOP_HEADER] = '1'
+        timeout = aiohttp.ClientTimeout(sock_connect=OPTS.timeout, sock_read=OPTS.timeout)
+        try:
+            response = await self.session.get(inquest.url, proxy=peer, headers=headers,
+                                              timeout=timeout)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.warning('Failed to forward request to peer %s (%s)', peer, e)
+            return False
+        async with response:
+            METRICS.peer_forwards += 1
+            output.set_status(response.status, response.reason)
+            output.headers.update(response.headers)
+            await output.prepare(downstream)
+            nbytes = await transfer_streams(response.content, output, 'Peer transfer',
+                                            bucket=BANDWIDTH.downstream(downstream.remote))
+            METRICS.downstream_bytes += nbytes
+        return True
+
+
+PEERS = Peers()
@@ -0,0 +1,126 @@
+import bisect, hashlib, logging, os
+from ipaddress import ip_address, ip_network
+
+#the tables here are built once, from the command line, and consulted on every request; this
+#module does not depend on OPTS, so that extras/benchmark.py can time them on their own
+
+
+class PrefixTable:
+    #(prefix, value) pairs, as a character trie: matching a string costs a dict lookup per
+    #character it shares with the prefixes, however many there are.  Of several prefixes that
+    #match, the first one given wins, as with the linear scan that this replaces
+    def __init__(self, pairs):
+        self.root = {}
+        for order, (prefix, value) in enumerate(pairs):
+            node = self.root
+            for char in prefix:
+                node = node.setdefault(char, {})
+            node.setdefault(None, (order, prefix, value))  #None: the end of a prefix
+
+    def __bool__(self):
+        return bool(self.root)
+
+    def match(self, string):
+        #the (prefix, value) of the first given prefix of string, or None
+        node = self.root
+        best = node.get(None, None)
+        for char in string:
+            node = node.get(char, None)
+            if node is None:
+                break
+            found = node.get(None, None)
+            if found is not None and (best is None or found[0] < best[0]):
+                best = found
+        return best and best[1:]
+
+
+class CidrTable:
+    #(network, value) pairs, grouped by ip version and prefix length: looking up an address
+    #masks it once per distinct prefix length (at most 33 for IPv4, 129 for IPv6) and looks the
+    #result up in a dict, however many networks there are.  Of several networks that contain
+    #the address, the first one given wins
+    def __init__(self, pairs):
+        tables = {4: {}, 6: {}}  #version -> prefix length -> network address -> (order, value)
+        for order, (network, value) in enumerate(pairs):
+            network = ip_network(network)
+            table = tables[network.version].setdefault(network.prefixlen, {})
+            table.setdefault(int(network.network_address), (order, value))
+        self.masks = {}  #version -> [(netmask, table)]
+        for version, bits in (4, 32), (6, 128):
+            self.masks[version] = [((1 << bits) - (1 << (bits - prefixlen)), table)
+                                   for prefixlen, table in sorted(tables[version].items())]
+
+    def __bool__(self):
+        return any(self.masks.values())
+
+    def lookup(self, ip, default=None):
+        #the value of the first given network that contains ip (an address or a string)
+        try:
+            ip = ip_address(ip)
+        except ValueError:
+            return default
+        address, best = int(ip), None
+        for netmask, table in self.masks[ip.version]:
+            found = table.get(address & netmask, None)
+            if found is not None and (best is None or found[0] < best[0]):
+                best = found
+        return default if best is None else best[1]
+
+
+class HashRing:
+    #consistent hashing of keys onto nodes: each node owns the arcs of a circle of hash values
+    #that end at its REPLICAS points, so that adding or removing a node only moves the keys of
+    #its own arcs.  Nodes that are given the same names agree on the owner of every key
+    REPLICAS = 160
+
+    def __init__(self, nodes):
+        self.points, self.owners = [], []
+        for point, node in sorted((self._hash(f'{node}#{i}'), node) for node in nodes
+                                  for i in range(self.REPLICAS)):
+            self.points.append(point)
+            self.owners.append(node)
+
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+    def __bool__(self):
+        return bool(self.points)
+
+    def owner(self, key):
+        #the node that key belongs to, or None if there are none
+        if not self.points:
+            return None
+        index = bisect.bisect(self.points, self._hash(key))
+        return self.owners[index % len(self.owners)]
+
+
+def normalize_path(origpath, maxlen, aliases):
+    #the cache path (below host:port) for a request path: normalized, with its query (if any)
+    #made part of the last component, overlong components shortened to fit maxlen, and the first
+    #matching --alias prefix (in aliases, a PrefixTable) replaced
+    path = os.sep + origpath
+    sep = path.find('?')
+    if sep != -1:
+        path = path[:sep] + path[sep:].replace('/', '%2F')
+    if path[-13:] == '.__download__':  #gentoo adds this to x-unique-cache-name
+        path = path[:-13]
+    path = os.path.normpath(path)
+    if 0 < maxlen:
+        path_parts = []
+        idxlimit = max(30, maxlen - 42)  #2 for '..' + 40 for hexdigest
+        for item in path.split(os.sep):
+            if maxlen < len(item):
+                itemhash = hashlib.shake_128(item.encode())
+                item = item[:idxlimit] + '..' + itemhash.hexdigest(20)
+            path_parts.append(item)
+        newpath = os.sep.join(path_parts)
+        if newpath != path:
+            logging.info('Shortened path to %s characters',
+                         '/'.join(str(len(w)) for w in path_parts))
+            path = newpath
+    alias = aliases.match(path)
+    if alias is not None:
+        prefix, destdir = alias
+        path = destdir + path[len(prefix):]
+    return path
@@ -1,5 +1,6 @@
-import asyncio, os, sys, time
+import logging, os, signal, sys, time
 from .Params import OPTS
+from .Bandwidth import BANDWIDTH, give_back_all, quantum, take_all
 
 
 def daemonize():
@@ -47,6 +48,35 @@ def daemonize():
     os.setsid()  #make the daemon its own session leader; should not fail, given its fresh pid
 
 
+def spawn_workers():
+    #fork the --workers processes, each of which returns from here to run its own event loop (all
+    #listening with SO_REUSEPORT); the parent stays behind, to pass on signals and reap workers
+    pids = {}
+    for worker in range(OPTS.workers):
+        pid = os.fork()
+        if not pid:
+            OPTS.worker = worker
+            return
+        pids[pid] = worker
+
+    def terminate(signum, frame):
+        for pid in pids:
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, terminate)
+    signal.signal(signal.SIGINT, terminate)
+    while pids:
+        pid, status = os.wait()
+        worker = pids.pop(pid, None)
+        if os.WIFEXITED(status) and os.WEXITSTATUS(status):
+            logging.warning('Worker %s (pid %d) exited with status %d', worker, pid,
+                            os.WEXITSTATUS(status))
+        elif os.WIFSIGNALED(status) and os.WTERMSIG(status) not in (signal.SIGTERM, signal.SIGINT):
+            logging.warning('Worker %s (pid %d) killed by signal %d', worker, pid,
+                            os.WTERMSIG(status))
+    sys.exit(0)
+
+
 def header_summary(headers, *, prefix='  ', maxlinelen=79, heading=None):
     summary = []
     if heading is not None:
@@ -61,15 +91,148 @@ def header_summary(headers, *, prefix='  ', maxlinelen=79, heading=None):
     return '\n'.join(summary)
 
 
-async def transfer_streams(reader, writer):
-    while True:
+def parse_ranges(header):
+    #the [(start, end)] of a Range header, end being exclusive, or None (up to the end of the file);
+    #suffix ranges have a negative start, and no end.  None for no (or an unusable) Range header,
+    #which means: all of the file
+    unit, _, specs = (header or '').partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+    ranges = []
+    for spec in specs.split(','):
+        first, dash, last = spec.strip().partition('-')
+        try:
+            if first:
+                start, end = int(first), int(last) + 1 if last else None
+            else:
+                start, end = -int(last), None
+        except ValueError:
+            return None
+        if not dash or (not first and 0 <= start) or (end is not None and end <= start):
+            return None
+        ranges.append((start, end))
+    return ranges
+
+
+def resolve_ranges(ranges, size):
+    #the satisfiable ones of ranges (as from parse_ranges) in a file of size bytes, as sorted
+    #[start, end) spans, with overlapping and adjacent ones merged
+    spans = []
+    for start, end in sorted((max(size + s, 0), size) if s < 0 else (s, min(e or size, size))
+                             for s, e in ranges):
+        if start >= end:
+            continue
+        if spans and start <= spans[-1][1]:
+            spans[-1] = (spans[-1][0], max(spans[-1][1], end))
+        else:
+            spans.append((start, end))
+    return spans
+
+
+def _validator_headers(responder, mtime):
+    if mtime is not None:
+        mtime_str = time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime(mtime))
+        responder.headers.update({'Last-Modified': mtime_str})
+    responder.headers.update({'Server': OPTS.version})
+
+
+def multipart_headers(responder, spans, size, mtime):
+    #status and headers for a multipart/byteranges response with the given spans of a file;
+    #returns the header of each part, and the closing delimiter, as bytes
+    _validator_headers(responder, mtime)
+    if not spans:
+        responder.headers.update({'Content-Range': f'bytes */{size}'})
+        responder.set_status(416)
+        return [], b''
+    boundary = os.urandom(12).hex()
+    heads = [(f'\r\n--{boundary}\r\nContent-Type: application/octet-stream\r\n'
+              f'Content-Range: bytes {start}-{end - 1}/{size}\r\n\r\n').encode()
+             for start, end in spans]
+    heads[0] = heads[0][2:]  #the first delimiter needs no CRLF in front
+    tail = f'\r\n--{boundary}--\r\n'.encode()
+    length = sum(map(len, heads)) + sum(end - start for start, end in spans) + len(tail)
+    responder.headers.update({
+        'Content-Type': f'multipart/byteranges; boundary={boundary}',
+        'Content-Length': str(length)
+    })
+    responder.set_status(206)
+    logging.debug('Replicator responds 206 Partial Content, in %d parts', len(spans))
+    if OPTS.verbose > 1:
+        logging.debug('%s', header_summary(responder.headers, heading='Response headers:'))
+    return heads, tail
+
+
+def response_headers(responder, start, end, size, mtime):
+    #status and headers for a response with [start, end) of a file of the given size and mtime;
+    #end, size and mtime may be None, when not (yet) known
+    _validator_headers(responder, mtime)
+    if end is not None and end <= start:  #a range that starts at or past the end of the file
+        responder.headers.update({'Content-Range': f'bytes */{size or end}'})
+        responder.set_status(416)
+        logging.debug('Replicator responds 416 Range Not Satisfiable')
+    elif (start, end) == (0, size):
+        if size is not None:
+            responder.headers.update({'Content-Length': str(size)})
+        responder.set_status(200)
+        logging.debug('Replicator responds 200 OK')
+    else:
+        if size is not None:
+            if end:
+                responder.headers.update({'Content-Range': f'bytes {start}-{end-1}/{size}'})
+            else:
+                responder.headers.update({'Content-Range': f'bytes {start}-/{size}'})
+        if end:
+            responder.headers.update({'Content-Length': str(end - start)})
+        responder.set_status(206)
+        logging.debug('Replicator responds 206 Partial Content')
+    if OPTS.verbose > 1:
+        logging.debug('%s', header_summary(responder.headers, heading='Response headers:'))
+
+
+class ChunkSizer:
+    #adaptive buffer size policy: aim for chunks holding about INTERVAL seconds worth of data at
+    #the observed transfer rate, so fast sustained transfers grow towards OPTS.maxchunk (one
+    #doubling per chunk) while slow or interactive peers drop back towards OPTS.minchunk
+    INTERVAL = 0.05
+
+    def __init__(self, name):
+        self.name = name
+        self.size = self.peak = OPTS.minchunk
+        self.nbytes = self.nchunks = 0
+
+    def update(self, nbytes, elapsed):
+        self.nbytes += nbytes
+        self.nchunks += 1
+        target = nbytes / max(elapsed, 1e-6) * self.INTERVAL
+        if self.size < target:
+            self.size = min(2 * self.size, OPTS.maxchunk)
+            self.peak = max(self.peak, self.size)
+        elif target < self.size / 2:
+            self.size = max(self.size // 2, OPTS.minchunk)
+
+    def report(self):
+        if self.nchunks:
+            logging.debug('%s: %d bytes in %d chunks (chunk size %d, peak %d)', self.name,
+                          self.nbytes, self.nchunks, self.size, self.peak)
+
+
+async def transfer_streams(reader, writer, name='Transfer', limit=None, bucket=None):
+    #copy until reader hits EOF or, if given a limit, until that many bytes have been copied;
+    #returns the number of bytes copied.  The reader is always an upstream server, so the copy
+    #draws on the --limit budget, and also on bucket, if given
+    buckets = BANDWIDTH.upstream, bucket
+    sizer = ChunkSizer(name)
+    while limit is None or sizer.nbytes < limit:
         start_time = time.time()
-        chunk = await reader.read(OPTS.maxchunk)
+        size = sizer.size if limit is None else min(sizer.size, limit - sizer.nbytes)
+        size = quantum(buckets, size)
+        await take_all(buckets, size)
+        chunk = await reader.read(size)
+        if len(chunk) < size:
+            give_back_all(buckets, size - len(chunk))
         if not chunk:
             break
         await writer.write(chunk)
-        if OPTS.limit:
-            target_time = len(chunk) / OPTS.limit
-            elapsed_time = time.time() - start_time
-            if elapsed_time < target_time:
-                await asyncio.sleep(target_time - elapsed_time)
+        sizer.update(len(chunk), time.time() - start_time)
+    sizer.report()
+    return sizer.nbytes
@@ -0,0 +1,165 @@
+import asyncio, concurrent.futures, fnmatch, gzip, logging, os, shutil
+from .Params import OPTS
+from .DiskIO import DISK
+
+try:
+    import zstandard  #optional: without it, only gzip variants are made
+except ImportError:
+    zstandard = None
+
+
+def _gzip(src, dst):
+    with gzip.GzipFile(fileobj=dst, mode='wb', compresslevel=9, mtime=0) as encoder:
+        shutil.copyfileobj(src, encoder, 1 << 20)
+
+
+def _zstd(src, dst):
+    zstandard.ZstdCompressor(level=12).copy_stream(src, dst)
+
+
+#content codings we can make, in our order of preference
+ENCODERS = {'zstd': _zstd, 'gzip': _gzip} if zstandard else {'gzip': _gzip}
+
+
+class Variants:
+    #compressed copies of complete cache files whose url matches a --compress pattern, made once
+    #per file version on a thread of their own, and served to clients that accept them.  They live
+    #below DIR, named after their cacheid and encoding, with the mtime of the file they were made
+    #from: one with any other mtime is out of date.  Keys are normalized, as in the index.
+    DIR = '.variants'
+    MIN_SIZE = 1024  #smaller files are not worth it
+    MAX_RATIO = 0.9  #variants which do not save at least 10% are not kept
+
+    def __init__(self):
+        self.known = {}  #cacheid -> (mtime, {encoding: size}) of its (current) variants
+        self.encoded = {}  #cacheid -> mtime of the file version last encoded
+        self.pending = set()  #cacheids being encoded
+        self.executor = None
+
+    def wanted(self, url):
+        url = str(url)
+        return any(fnmatch.fnmatchcase(url, pattern) for pattern in OPTS.compress)
+
+    def accepted(self, header):
+        #the encodings we can make that an Accept-Encoding header allows, most preferred first
+        prefs = {}
+        for item in header.split(','):
+            name, _, params = item.partition(';')
+            qvalue = params.strip().lower()
+            try:
+                prefs[name.strip().lower()] = float(qvalue[2:]) if qvalue[:2] == 'q=' else 1.0
+            except ValueError:
+                pass
+        star = prefs.get('*', 0.0)
+        return sorted((e for e in ENCODERS if prefs.get(e, star) > 0),
+                      key=lambda e: -prefs.get(e, star))
+
+    def path(self, cacheid, encoding):
+        return os.path.join(self.DIR, f'{os.path.normpath(cacheid)}.{encoding}')
+
+    def _probe(self, key, mtime):
+        #(runs on a disk thread) the sizes of the variants of key made from the file with mtime
+        sizes = {}
+        for encoding in ENCODERS:
+            try:
+                stat = os.stat(self.path(key, encoding))
+            except OSError:
+                continue
+            if stat.st_mtime == mtime:
+                sizes[encoding] = stat.st_size
+        return sizes
+
+    async def lookup(self, cacheid, encodings, mtime):
+        #(path, encoding, size) of the most preferred of encodings of cacheid, made from the
+        #file with mtime, or None
+        key = os.path.normpath(cacheid)
+        known = self.known.get(key, None)
+        if known is None or known[0] != mtime:
+            known = self.known[key] = mtime, await DISK.path_call(self._probe, key, mtime)
+        for encoding in encodings:
+            if encoding in known[1]:
+                return self.path(key, encoding), encoding, known[1][encoding]
+        return None
+
+    def _encode(self, key, mtime):
+        #(runs on the encoder thread) make the variants of the complete cache file key
+        sizes = {}
+        with open(key, 'rb') as src:
+            size = os.fstat(src.fileno()).st_size
+            for encoding, encoder in ENCODERS.items():
+                path = self.path(key, encoding)
+                temppath = path + OPTS.suffix
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                src.seek(0)
+                with open(temppath, 'wb') as dst:
+                    encoder(src, dst)
+                    encoded = dst.tell()
+                if size * self.MAX_RATIO < encoded:
+                    os.remove(temppath)
+                    continue
+                if os.fstat(src.fileno()).st_mtime != mtime:
+                    os.remove(temppath)  #the file changed under our feet
+                    break
+                os.utime(temppath, (mtime, mtime))
+                os.rename(temppath, path)
+                sizes[encoding] = encoded
+        return size, sizes
+
+    def schedule(self, cacheid, url, size, mtime):
+        #make variants of a complete cache file in the background, unless there are some already
+        key = os.path.normpath(cacheid)
+        if (mtime is None or size < self.MIN_SIZE or key in self.pending
+                or self.encoded.get(key, None) == mtime or not self.wanted(url)):
+            return
+        self.pending.add(key)
+        asyncio.ensure_future(self._make(key, mtime))
+
+    async def _make(self, key, mtime):
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix='replicator-encode')
+        loop = asyncio.get_event_loop()
+        try:
+            sizes = await loop.run_in_executor(self.executor, self._probe, key, mtime)
+            self.known[key] = mtime, sizes
+            if sizes:
+                self.encoded[key] = mtime
+            else:
+                size, sizes = await loop.run_in_executor(self.executor, self._encode, key, mtime)
+                if self.known.get(key, (None, ))[0] == mtime:  #not discarded meanwhile
+                    self.known[key] = mtime, sizes
+                    self.encoded[key] = mtime
+                logging.info('Encoded %s (%d bytes) as %s', key, size,
+                             ', '.join(f'{e} ({n} bytes)' for e, n in sizes.items()) or 'nothing')
+        except Exception as e:
+            logging.warning('Failed to encode %s (%s)', key, e)
+        finally:
+            self.pending.discard(key)
+
+    def _remove(self, key):
+        #(runs on a disk thread)
+        for encoding in ENCODERS:
+            try:
+                os.remove(self.path(key, encoding))
+            except FileNotFoundError:
+                pass
+
+    def forget(self, cacheid):
+        key = os.path.normpath(cacheid)
+        self.known.pop(key, None)
+        self.encoded.pop(key, None)
+        return key
+
+    async def discard(self, cacheid):
+        #forget, and remove, the variants of a cache file that is about to change or go away
+        key = self.forget(cacheid)
+        if OPTS.compress:
+            await DISK.path_call(self._remove, key)
+
+    def stop(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+
+VARIANTS = Variants()
@@ -0,0 +1,84 @@
+import asyncio, itertools, logging, time
+from yarl import URL
+from .Params import OPTS
+
+
+class WarmJob:
+    __slots__ = 'id', 'urls', 'done', 'failed', 'started', 'finished'
+
+    def __init__(self, job_id, urls):
+        self.id = job_id
+        self.urls = urls
+        self.done = 0  #urls fetched (or found fresh) so far
+        self.failed = []  #[(url, reason)]
+        self.started = time.time()
+        self.finished = None
+
+    def report(self):
+        return {
+            'job': self.id,
+            'total': len(self.urls),
+            'done': self.done,
+            'failed': len(self.failed),
+            'pending': len(self.urls) - self.done - len(self.failed),
+            'started': self.started,
+            'finished': self.finished,
+            'errors': [{'url': url, 'error': reason} for url, reason in self.failed],
+        }
+
+
+class Warmer:
+    #fills the cache ahead of client requests: each job is a list of urls, which fetch(url) gets
+    #into the cache (raising what it failed with, if it does), with at most --warmconns
+    #fetches in flight per upstream host.  Only the last KEEP jobs are remembered for reporting.
+    KEEP = 100
+
+    def __init__(self, fetch):
+        self.fetch = fetch
+        self.hosts = {}  #host:port -> semaphore
+        self.jobs = {}  #id -> WarmJob, oldest first
+        self.ids = itertools.count(1)
+
+    @staticmethod
+    def parse(text):
+        #a manifest is a list of urls, one per line; blank lines and #comments are skipped
+        urls = []
+        for line in text.splitlines():
+            line = line.strip()
+            if line and not line.startswith('#'):
+                urls.append(line)
+        return urls
+
+    def submit(self, urls):
+        job = WarmJob(next(self.ids), urls)
+        self.jobs[job.id] = job
+        while self.KEEP < len(self.jobs):
+            oldest = next(iter(self.jobs))
+            if self.jobs[oldest].finished is None:
+                break
+            del self.jobs[oldest]
+        logging.info('Warming job %d: %d urls', job.id, len(urls))
+        asyncio.ensure_future(self._run(job))
+        return job
+
+    async def _run(self, job):
+        await asyncio.gather(*(self._warm(job, url) for url in job.urls))
+        job.finished = time.time()
+        logging.info('Warming job %d finished: %d fetched, %d failed', job.id, job.done,
+                     len(job.failed))
+
+    async def _warm(self, job, url):
+        try:
+            parsed = URL(url)
+            assert parsed.is_absolute(), 'not an absolute url'
+            host = f'{parsed.host}:{parsed.port}'
+            queue = self.hosts.get(host, None)
+            if queue is None:
+                queue = self.hosts[host] = asyncio.Semaphore(OPTS.warmconns)
+            async with queue:
+                await self.fetch(parsed)
+            job.done += 1
+        except Exception as e:
+            reason = str(e) or e.__class__.__name__
+            logging.warning('Warming job %d failed to fetch %s (%s)', job.id, url, reason)
+            job.failed.append((url, reason))